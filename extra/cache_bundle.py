@@ -0,0 +1,12 @@
+# build a read-only kernel cache bundle from a model run, then ship it and mount it with CACHEBUNDLES=bundle.db
+# usage: python3 extra/cache_bundle.py bundle.db examples/beautiful_mnist.py [args...]
+import sys, runpy
+from tinygrad.helpers import diskcache_record, diskcache_export
+
+if __name__ == "__main__":
+  if len(sys.argv) < 3: raise SystemExit(f"usage: {sys.argv[0]} <bundle.db> <script.py> [args...]")
+  fn, script = sys.argv[1], sys.argv[2]
+  sys.argv = sys.argv[2:]
+  with diskcache_record() as rows:
+    try: runpy.run_path(script, run_name="__main__")
+    finally: print(f"wrote {diskcache_export(fn, rows)} cache rows to {fn}")
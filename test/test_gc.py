@@ -5,7 +5,7 @@ import numpy as np
 from tinygrad.device import Buffer
 from tinygrad.engine.realize import run_schedule
 from tinygrad.uop.ops import UOp
-from tinygrad.tensor import Tensor
+from tinygrad.tensor import Tensor, uop_tensors
 
 def tensors_allocated():
   gc.collect()
@@ -109,5 +109,27 @@ class TestGC(unittest.TestCase):
     self.assertEqual(real_buf.uop_refcount, 0) # no UOps for this Buffer
     self.assertEqual(bufs_allocated()-init, 1) # Buffer is alive
 
+  def test_uop_tensors_gc(self):
+    init = bufs_allocated()
+    a = Tensor.ones(4).contiguous()
+    b, c = a+1, a+1
+    self.assertEqual(len(uop_tensors[b.uop]), 2)
+    b.realize()
+    # c is found through the index and gets the realized UOp too
+    self.assertIs(c.uop, b.uop)
+    self.assertEqual(c.tolist(), [2.,2.,2.,2.])
+    del a, b, c
+    self.assertEqual(bufs_allocated()-init, 0)
+
+  def test_uop_tensors_gc_cycle(self):
+    init, init_uops = bufs_allocated(), len(uop_tensors)
+    for _ in range(5):
+      # the cycle collector clears the weakrefs to the Tensor before its __del__
+      cycle = [Tensor.ones(4).contiguous().realize()]
+      cycle.append(cycle)
+    del cycle
+    self.assertEqual(bufs_allocated()-init, 0)
+    self.assertEqual(len(uop_tensors)-init_uops, 0)
+
 if __name__ == '__main__':
   unittest.main()
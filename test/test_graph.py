@@ -5,7 +5,8 @@ from tinygrad.device import Device, Buffer
 from tinygrad.tensor import Tensor, _to_np_dtype
 from tinygrad.helpers import Context, CI, dedup, from_mv
 from tinygrad.dtype import dtypes
-from tinygrad.engine.jit import MultiGraphRunner
+from tinygrad.uop.ops import UOp
+from tinygrad.engine.jit import MultiGraphRunner, TinyJit
 from tinygrad.engine.realize import ExecItem, BufferXfer, get_runner, CompiledRunner
 
 np.random.seed(1337)
@@ -257,5 +258,45 @@ class TestGraph(unittest.TestCase):
 
     helper_test_graphs(Device[d0].graph, graphs)
 
+@unittest.skipUnless(Device.DEFAULT == "CPU", "CPU graph")
+class TestCPUGraph(unittest.TestCase):
+  def test_symbolic_batch(self):
+    from tinygrad.runtime.graph.cpu import CPUGraph
+    vi = UOp.variable("i", 1, 10)
+    @TinyJit
+    def f(a, b): return ((a+b).contiguous()*2).sum().realize()
+    for i in range(2, 7):
+      a, b = Tensor.arange(10).float().contiguous().realize(), Tensor.ones(10).contiguous().realize()
+      self.assertEqual(f(a[:vi.bind(i)], b[:vi.bind(i)]).item(), 2*sum(range(i))+2*i)
+    self.assertTrue(all(isinstance(ei.prg, CPUGraph) for ei in f.captured._jit_cache))
+
+  def test_independent_kernels(self):
+    ws = [Tensor.rand(8, 8).realize() for _ in range(3)]
+    for threads, waves in [(1, [[0]]), (4, [[0, 1, 2], [3]])]:
+      with Context(CPU_THREADS=threads):
+        @TinyJit
+        def f(x):
+          a, b, c = [(x@w).realize() for w in ws]
+          return (a+b+c).realize()
+        for _ in range(3):
+          x = Tensor.rand(8, 8).realize()
+          np.testing.assert_allclose(f(x).numpy(), sum(x.numpy()@w.numpy() for w in ws), atol=1e-5, rtol=1e-5)
+        self.assertEqual(f.captured._jit_cache[0].prg.waves, waves)
+
+  def test_independent_kernels_planned(self):
+    # the replan puts the intermediates in one arena, the kernels writing different ranges of it still run at the same time
+    ws = [Tensor.rand(8, 8).realize() for _ in range(3)]
+    with Context(CPU_THREADS=4):
+      def fxn(x):
+        a, b, c = [(x@w).contiguous() for w in ws]
+        return (a+b+c).realize()
+      f = TinyJit(fxn, optimize=True)
+      for _ in range(3):
+        x = Tensor.rand(8, 8).realize()
+        np.testing.assert_allclose(f(x).numpy(), sum(x.numpy()@w.numpy() for w in ws), atol=1e-5, rtol=1e-5)
+      graph = f.captured._jit_cache[0].prg
+      self.assertEqual(len(dedup(b.base for ji in graph.jit_cache[:3] for b in ji.bufs[:1])), 1)
+      self.assertEqual(graph.waves, [[0, 1, 2], [3]])
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
-import unittest, functools
+import unittest, unittest.mock, functools
 import numpy as np
 
 from hypothesis import given, settings, strategies as strat
 from test.helpers import assert_jit_cache_len, not_support_multi_device, REAL_DEV
 from tinygrad.tensor import Tensor
-from tinygrad.engine.jit import TinyJit
+from tinygrad.engine.jit import TinyJit, host_callback
+from tinygrad.engine.realize import ExecItem, HostCallback, CompiledRunner
 from tinygrad.device import Device
 from tinygrad.helpers import Context, JIT, GlobalCounters
 from tinygrad.dtype import dtypes
@@ -45,6 +46,112 @@ class TestJit(unittest.TestCase):
     add.reset()
     _simple_test(add, N=20)
 
+  def test_jit_multi_signature(self):
+    @functools.partial(TinyJit, max_captures=2)
+    def add(a, b): return (a+b).realize()
+    for N in [10, 20, 10, 20, 10]:
+      a, b = Tensor.randn(N, N), Tensor.randn(N, N)
+      np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-4, rtol=1e-5)
+    assert_jit_cache_len(add, 1)
+    self.assertEqual(len(add._captures), 1)
+
+  def test_jit_multi_signature_evict(self):
+    @functools.partial(TinyJit, max_captures=2)
+    def add(a, b): return (a+b).realize()
+    for N in [10, 20, 30]:
+      for _ in range(3): add(Tensor.randn(N, N), Tensor.randn(N, N))
+    # 30 is active and 20 is kept, 10 was evicted
+    self.assertEqual([sig[1][0][0].shape for sig in add._captures], [(20, 20)])
+    a, b = Tensor.randn(10, 10), Tensor.randn(10, 10)
+    np.testing.assert_allclose(add(a, b).numpy(), a.numpy()+b.numpy(), atol=1e-4, rtol=1e-5)
+    self.assertIsNone(add.captured)
+
+  def test_jit_buckets(self):
+    @functools.partial(TinyJit, buckets=(4, 8))
+    def double(a): return (a*2).realize()
+    for N in [3, 4, 2, 1]:
+      a = Tensor.randn(N, 5)
+      out = double(a)
+      self.assertEqual(out.shape, (4, 5))
+      np.testing.assert_allclose(out[:N].numpy(), a.numpy()*2, atol=1e-4, rtol=1e-5)
+      np.testing.assert_equal(out[N:].numpy(), 0)
+    assert_jit_cache_len(double, 1)
+
+  def test_jit_buckets_multiple(self):
+    # each bucket is captured on its own
+    @functools.partial(TinyJit, buckets=(4, 8))
+    def double(a): return (a*2).realize()
+    for N in [6, 7, 5, 3, 8, 2]:
+      a = Tensor.randn(N, 5)
+      out = double(a)
+      self.assertEqual(out.shape, (4 if N <= 4 else 8, 5))
+      np.testing.assert_allclose(out[:N].numpy(), a.numpy()*2, atol=1e-4, rtol=1e-5)
+    with self.assertRaises(ValueError): double(Tensor.randn(9, 5))
+
+  def test_jit_capture_first(self):
+    calls = 0
+    @functools.partial(TinyJit, capture_first=True)
+    def add(a, b):
+      nonlocal calls
+      calls += 1
+      return (a+b).realize()
+    _simple_test(add)
+    self.assertEqual(calls, 1)
+
+  def test_jit_capture_first_initializes_state(self):
+    w = Tensor.rand(10, 10)
+    calls = 0
+    @functools.partial(TinyJit, capture_first=True)
+    def mul(a):
+      nonlocal calls
+      calls += 1
+      return (a*w).realize()
+    outs = [(a:=Tensor.randn(10, 10), mul(a).numpy()) for _ in range(4)]
+    # the first call realizes w, so it's a warmup and the second call is captured
+    self.assertEqual(calls, 2)
+    for a,out in outs: np.testing.assert_allclose(out, a.numpy()*w.numpy(), atol=1e-4, rtol=1e-5)
+
+  def test_jit_output_fed_back(self):
+    @TinyJit
+    def step(a): return (a*2+1).realize()
+    t = Tensor([1.]).realize()
+    for _ in range(4): t = step(t)
+    self.assertEqual(t.item(), 31.)
+    # an input that isn't the jit's own output in between
+    self.assertEqual(step(Tensor([2.]).realize()).item(), 5.)
+    self.assertEqual((t:=step(t)).item(), 11.)
+    self.assertEqual(step(t).item(), 23.)
+
+  def test_jit_replay_plan(self):
+    @TinyJit
+    def f(a, b): return ((a+b).contiguous()*2).sum(1).realize()
+    # graphs stay ExecItems in the plan, so this is ungraphed
+    with Context(JIT=2):
+      for _ in range(3): f(Tensor.randn(10, 10), Tensor.randn(10, 10))
+      a, b = Tensor.randn(10, 10).realize(), Tensor.randn(10, 10).realize()
+      GlobalCounters.reset()
+      # the replay calls the programs directly, not through ExecItem.run
+      with unittest.mock.patch.object(ExecItem, "run", side_effect=AssertionError("ExecItem.run in replay")):
+        out = f(a, b)
+    self.assertEqual(GlobalCounters.kernel_count, len(f.jit_cache))
+    self.assertGreater(GlobalCounters.global_ops, 0)
+    np.testing.assert_allclose(out.numpy(), ((a.numpy()+b.numpy())*2).sum(1), atol=1e-4, rtol=1e-5)
+
+  def test_jit_host_callback(self):
+    calls = 0
+    def sample(logits):
+      nonlocal calls
+      calls += 1
+      return [logits.argmax()]
+    @TinyJit
+    def step(x): return (host_callback(sample, x*2, shape=(1,), dtype=dtypes.int32)+1).realize()
+    for _ in range(5):
+      x = Tensor.randn(10).realize()
+      self.assertEqual(step(x).item(), np.argmax(x.numpy())+1)
+    # the replays call sample in between the kernels
+    self.assertEqual(calls, 5)
+    self.assertEqual([type(ei.prg) for ei in step.jit_cache if not isinstance(ei.prg, CompiledRunner)], [HostCallback])
+
   def test_simple_jit_norealize(self):
     @TinyJit
     def add(a, b): return (a+b)
@@ -657,17 +764,24 @@ class TestJitFree(unittest.TestCase):
     ext_tensor_2 = Tensor([2,2,2,2,2])
     @TinyJit
     def fxn(x:Tensor):
-      out = (x*ext_tensor_2+ext_tensor).reshape(5,1).expand(5, 100).contiguous()
+      out = (x*ext_tensor_2+ext_tensor).reshape(5,1).expand(5, 2000).contiguous()
+      out = ((out+1).contiguous()*2).contiguous()
       return out.sum()
-    for i in range(5):
-      out = fxn(Tensor([i,1,2,3,4]))
-      self.assertEqual(out.item(), 11400+200*i)
-    assert len(set([b.base for item in fxn.captured.jit_cache for b in item.bufs if b is not None])) == 4
-    fxn.captured.replan_buffers_memory_layout()
-    assert len(set([b.base for item in fxn.captured.jit_cache for b in item.bufs if b is not None])) == 2
-
-    out = fxn(Tensor([11,1,2,3,4]))
-    self.assertEqual(out.item(), 13600)
+    # capture without the memory planner, so each intermediate has its own buffer
+    with Context(NO_MEMORY_PLANNER=1):
+      for i in range(5):
+        out = fxn(Tensor([i,1,2,3,4]))
+        self.assertEqual(out.item(), 476000+8000*i)
+    assert len(set([b.base for item in fxn.captured.jit_cache for b in item.bufs if b is not None])) > 4
+    before, after = fxn.captured.replan_buffers_memory_layout()
+    self.assertLess(after, before)
+    # the params and the output keep their buffers, the intermediates share an arena
+    bases = set([b.base for item in fxn.captured.jit_cache for b in item.bufs if b is not None])
+    assert len(bases) == 4 and ext_tensor.uop.buffer in bases and ext_tensor_2.uop.buffer in bases
+
+    for i in range(2):
+      out = fxn(Tensor([11+i,1,2,3,4]))
+      self.assertEqual(out.item(), 564000+8000*i)
 
 if __name__ == '__main__':
   unittest.main()
@@ -999,6 +999,18 @@ class TestFloat4(unittest.TestCase):
       assert count == expected, f"{count=}, {expected=}"
 
 class TestHandCodedOpts(unittest.TestCase):
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.has_threads, "renderer has no threads")
+  def test_cpu_threads(self):
+    a, b = Tensor.rand(256, 256).realize(), Tensor.rand(256, 256).realize()
+    with Context(CPU_THREADS=4):
+      p = get_program((a@b).schedule()[-1].ast, Device[Device.DEFAULT].renderer)
+      self.assertIn(Opt(OptOps.THREAD, 0, 4), p.uops[-1].arg.applied_opts)
+      self.assertEqual(p.global_size, [4, 1, 1])
+      np.testing.assert_allclose((a@b).numpy(), a.numpy() @ b.numpy(), atol=1e-4, rtol=1e-4)
+      # too little work to split
+      p = get_program((a[:8, :8]+1).contiguous().schedule()[-1].ast, Device[Device.DEFAULT].renderer)
+      self.assertNotIn(OptOps.THREAD, [o.op for o in p.uops[-1].arg.applied_opts])
+
   def test_masked_upcast(self):
     layer_1 = Tensor.cat(*[Tensor.empty(5) for _ in range(4)])
     layer_2 = Tensor.cat(layer_1.unsqueeze(0), Tensor.empty(6, 20))
@@ -1,5 +1,8 @@
-import unittest
+import unittest, random
+from unittest.mock import patch
 from tinygrad import Tensor, Device, Variable
+from tinygrad.engine import realize
+from tinygrad.helpers import Context
 from examples.gpt2 import Transformer
 from tinygrad.nn.state import get_state_dict
 
@@ -30,6 +33,59 @@ class TestMethodCache(unittest.TestCase):
     Device[Device.DEFAULT].compiler = None
     ((c+d)+(a+b)).realize()
 
+  def test_cpu_threads_context(self):
+    ast = (Tensor([1,2,3]) + 4812907).schedule()[-1].ast
+    with Context(CPU_THREADS=1): r1 = realize.get_runner(Device.DEFAULT, ast)
+    with Context(CPU_THREADS=4): r2 = realize.get_runner(Device.DEFAULT, ast)
+    self.assertIsNot(r1, r2)
+
+  def test_persistent_program_cache(self):
+    unique_const = 7123584
+    with Context(PROGRAM_CACHE=1):
+      (Tensor([1,2,3]) + unique_const).realize()
+      realize.method_cache.clear()
+      with patch.object(realize, "get_program", side_effect=AssertionError("shouldn't lower")):
+        self.assertEqual((Tensor([4,5,6]) + unique_const).tolist(), [4+unique_const, 5+unique_const, 6+unique_const])
+
+  def test_persistent_program_cache_context(self):
+    # a fresh constant, the cache outlives the test
+    unique_const = random.randint(1<<20, 1<<23)
+    with Context(PROGRAM_CACHE=1):
+      (Tensor([1,2,3]) + unique_const).realize()
+      realize.method_cache.clear()
+      # a different config lowers again instead of getting the cached program
+      with Context(CPU_THREADS=2), patch.object(realize, "get_program", wraps=realize.get_program) as get_program:
+        self.assertEqual((Tensor([4,5,6]) + unique_const).tolist(), [4+unique_const, 5+unique_const, 6+unique_const])
+      get_program.assert_called_once()
+
+  def test_persistent_program_cache_debug(self):
+    unique_const = random.randint(1<<20, 1<<23)
+    with Context(PROGRAM_CACHE=1):
+      (Tensor([1,2,3]) + unique_const).realize()
+      realize.method_cache.clear()
+      # debug verbosity doesn't change the program
+      with Context(DEBUG=1), patch.object(realize, "get_program", side_effect=AssertionError("shouldn't lower")):
+        self.assertEqual((Tensor([4,5,6]) + unique_const).tolist(), [4+unique_const, 5+unique_const, 6+unique_const])
+
+  def test_parallel_compile(self):
+    with Context(PARALLEL_COMPILE=2):
+      a = Tensor.arange(16).reshape(4,4).contiguous() + 3810
+      self.assertEqual(((a*2).sum(0) + a.max(1)).tolist(), [(3810*4+24+i*4)*2 + 3810+4*i+3 for i in range(4)])
+    self.assertEqual(len(realize.compile_futures), 0)
+
+  def test_compile_ahead(self):
+    with Context(COMPILE_AHEAD=2):
+      a = Tensor.arange(16).reshape(4,4).contiguous() + 2914
+      self.assertEqual(((a*2).sum(0) + a.max(1)).tolist(), [(2914*4+24+i*4)*2 + 2914+4*i+3 for i in range(4)])
+    self.assertEqual(len(realize.compile_futures), 0)
+
+  def test_compile_ahead_error(self):
+    # the kernels compiled ahead aren't left behind when lowering fails
+    with Context(COMPILE_AHEAD=2), patch.object(realize, "lower_schedule_item", side_effect=RuntimeError("lowering failed")):
+      a = Tensor([1,2,3]).contiguous() + 9142
+      with self.assertRaisesRegex(RuntimeError, "lowering failed"): ((a*2).contiguous() + a.max()).realize()
+    self.assertEqual(len(realize.compile_futures), 0)
+
   @unittest.skip("incorrect use of transformer")
   def test_small_transformer(self):
     args_tiny = {"dim": 16, "n_heads": 8, "n_layers": 8, "norm_eps": 1e-05, "vocab_size": 10}
@@ -611,6 +611,38 @@ class TestSchedule(unittest.TestCase):
     e = c * d
     check_schedule(e, 2)
 
+  def test_expand_rematerialize(self):
+    a = Tensor.empty(1, 16)
+    b = Tensor.empty(1, 16)
+    d = Tensor.empty(8192, 16)
+    with Context(MEMORY_BUDGET=1<<20): check_schedule(a*b*d, 2)
+    # over the budget, a*b is recomputed in the expand instead of realized
+    with Context(MEMORY_BUDGET=1): check_schedule(a*b*d, 1)
+
+  def test_rematerialize_assign(self):
+    a = Tensor.ones(1, 16).contiguous().realize()
+    d = Tensor.ones(8192, 16).contiguous().realize()
+    e = (a*2).exp2()*d
+    a.assign(a+1)
+    # a*2 reads a before it's assigned, so it isn't recomputed
+    with Context(MEMORY_BUDGET=1): run_schedule(check_schedule([e, a], 3))
+    np.testing.assert_equal(e.numpy(), 4)
+    np.testing.assert_equal(a.numpy(), 2)
+
+  def test_rematerialize_masked_reader(self):
+    t, a, b = Tensor([[0.5]]).realize(), Tensor([[1.], [2.]]).realize(), Tensor([[3.], [-4.]]).realize()
+    c = 1 / (1 + t.square()).sqrt()
+    # c is only read by elementwise ops, the cat pads them. recomputed in the cat, the pad would reach the reciprocal of c
+    out = (c*a - c*b).cat(c*b + c*a, dim=-1)
+    with Context(MEMORY_BUDGET=1): run_schedule(check_schedule(out, 2))
+    cn = 1 / np.sqrt(1.25)
+    np.testing.assert_allclose(out.numpy(), [[-2*cn, 4*cn], [6*cn, -2*cn]], rtol=1e-6)
+
+  def test_rematerialize_svd(self):
+    a = np.random.default_rng(0).standard_normal((4, 4)).astype(np.float32)
+    with Context(MEMORY_BUDGET=1): S = Tensor.svd(Tensor(a))[1].numpy()
+    np.testing.assert_allclose(S, np.linalg.svd(a, compute_uv=False), rtol=1e-4, atol=1e-4)
+
   # this is the failing case in openpilot...it's very simple like this
   def test_image_conv_fusion(self):
     w1 = Tensor.empty(16, 16, 1, 1)
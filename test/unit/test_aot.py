@@ -0,0 +1,149 @@
+import unittest, tempfile, subprocess, sys, os, pickle, io, random
+from unittest.mock import patch
+from tinygrad import Tensor, TinyJit, Device
+from tinygrad.engine.jit import CapturedJit
+from tinygrad.engine.aot import export_jit, load_jit, jit_params, unknown_buffers, _JitPickler, _JitUnpickler
+from tinygrad.helpers import VERSION
+
+w = Tensor.arange(12).reshape(3, 4).float().contiguous().realize()
+@TinyJit
+def matvec(x:Tensor) -> Tensor: return (w @ x).relu().realize()
+def example_inputs(): return (Tensor.ones(4).contiguous().realize(),)
+
+# loads the artifact with no model code and fails if anything gets lowered
+LOADER = """
+import sys
+from tinygrad import Tensor
+from tinygrad.engine import realize
+from tinygrad.engine.aot import load_jit
+def fail(*args): raise AssertionError("lowered a kernel")
+realize.get_program = realize.get_program_cached = fail
+print(load_jit(sys.argv[1])(Tensor([1., 2., 3., 4.]).realize()).tolist())
+"""
+
+# runs a TinyJit with a cache_key three times, prints the output and how often the function was called
+CACHED = """
+import sys
+from tinygrad import Tensor, TinyJit
+from tinygrad.engine import realize
+calls = 0
+w = Tensor.arange(12).reshape(3, 4).float().contiguous().realize()
+def matvec(x):
+  global calls
+  calls += 1
+  return (w @ x).relu().realize()
+if sys.argv[1] == "load":
+  def fail(*args): raise AssertionError("lowered a kernel")
+  realize.get_program = realize.get_program_cached = fail
+jit = TinyJit(matvec, cache_key="matvec")
+for _ in range(3): out = jit(Tensor([1., 2., 3., 4.]).realize())
+print(out.tolist(), calls)
+"""
+
+# the weights are scaled by argv[1] and only used through a helper, jit_params can't find them
+INDIRECT = """
+import sys
+from tinygrad import Tensor, TinyJit
+w = Tensor.ones(4, 4).mul(int(sys.argv[1])).contiguous().realize()
+def helper(x): return w @ x
+def step(x): return helper(x).realize()
+jit = TinyJit(step, cache_key=sys.argv[2])
+for _ in range(3): out = jit(Tensor.ones(4).contiguous().realize())
+print(out.tolist())
+"""
+
+class TestAOT(unittest.TestCase):
+  def test_export_load(self):
+    with tempfile.TemporaryDirectory() as d:
+      export_jit(matvec, fn:=os.path.join(d, "matvec.jit"), example_inputs)
+      self.assertEqual(load_jit(fn)(Tensor([1., 2., 3., 4.]).realize()).tolist(), [20., 60., 100.])
+
+  def test_lazy_load(self):
+    with tempfile.TemporaryDirectory() as d:
+      export_jit(matvec, fn:=os.path.join(d, "matvec.jit"), example_inputs)
+      jit = load_jit(fn, prewarm=False)
+      runners = [ei.prg for ei in jit.jit_cache]
+      self.assertTrue(all(r._loaded_prg is None for r in runners))
+      self.assertEqual(jit(Tensor([1., 2., 3., 4.]).realize()).tolist(), [20., 60., 100.])
+      self.assertTrue(all(r._loaded_prg is not None for r in runners))
+
+  def test_prewarm(self):
+    with tempfile.TemporaryDirectory() as d:
+      export_jit(matvec, fn:=os.path.join(d, "matvec.jit"), example_inputs)
+      with patch.object(type(Device[Device.DEFAULT]), "threadsafe_runtime", True):
+        (captured:=load_jit(fn).captured).prewarm().join()
+      self.assertTrue(all(ei.prg._loaded_prg is not None for ei in captured.jit_cache))
+
+  def test_prewarm_not_threadsafe(self):
+    # programs of a device that isn't threadsafe aren't loaded in the background
+    with tempfile.TemporaryDirectory() as d:
+      export_jit(matvec, fn:=os.path.join(d, "matvec.jit"), example_inputs)
+      with patch.object(type(Device[Device.DEFAULT]), "threadsafe_runtime", False):
+        (captured:=load_jit(fn, prewarm=True).captured).prewarm().join()
+      self.assertTrue(all(ei.prg._loaded_prg is None for ei in captured.jit_cache))
+
+  def test_cli_load_without_model(self):
+    with tempfile.TemporaryDirectory() as d:
+      fn = os.path.join(d, "matvec.jit")
+      subprocess.run([sys.executable, "-m", "tinygrad.engine.aot", "test.unit.test_aot:matvec", "test.unit.test_aot:example_inputs", fn], check=True)
+      out = subprocess.run([sys.executable, "-c", LOADER, fn], check=True, stdout=subprocess.PIPE)
+      self.assertEqual(out.stdout.decode().strip(), "[20.0, 60.0, 100.0]")
+
+  def test_cache_key_across_processes(self):
+    with tempfile.TemporaryDirectory() as d:
+      env = {**os.environ, "CACHEDB": os.path.join(d, "cache.db")}
+      out = subprocess.run([sys.executable, "-c", CACHED, "save"], check=True, stdout=subprocess.PIPE, env=env)
+      self.assertEqual(out.stdout.decode().strip(), "[20.0, 60.0, 100.0] 2")
+      # the next process loads the capture, it doesn't call matvec or lower anything
+      out = subprocess.run([sys.executable, "-c", CACHED, "load"], check=True, stdout=subprocess.PIPE, env=env)
+      self.assertEqual(out.stdout.decode().strip(), "[20.0, 60.0, 100.0] 0")
+
+  def test_cache_key_no_prewarm(self):
+    def fxn(x:Tensor) -> Tensor: return (w @ x).relu().realize()
+    key = f"test_cache_key_no_prewarm_{random.getrandbits(32)}"
+    jit = TinyJit(fxn, cache_key=key)
+    for _ in range(3): jit(Tensor.ones(4).contiguous().realize())
+    # restoring a capture doesn't start loading programs in the background
+    with patch.object(CapturedJit, "prewarm", side_effect=AssertionError("prewarmed")):
+      loaded = TinyJit(fxn, cache_key=key)
+      self.assertEqual(loaded(Tensor([1., 2., 3., 4.]).realize()).tolist(), [20., 60., 100.])
+      self.assertIsNotNone(loaded.captured)
+
+  def test_cache_key_indirect_weights(self):
+    with tempfile.TemporaryDirectory() as d:
+      env, key = {**os.environ, "CACHEDB": os.path.join(d, "cache.db")}, f"step_{random.getrandbits(32)}"
+      out = subprocess.run([sys.executable, "-c", INDIRECT, "1", key], check=True, stdout=subprocess.PIPE, env=env)
+      self.assertEqual(out.stdout.decode().strip(), "[4.0, 4.0, 4.0, 4.0]")
+      # the capture wasn't saved with the weights of the first process in it
+      out = subprocess.run([sys.executable, "-c", INDIRECT, "5", key], check=True, stdout=subprocess.PIPE, env=env)
+      self.assertEqual(out.stdout.decode().strip(), "[20.0, 20.0, 20.0, 20.0]")
+
+  def test_unknown_buffers(self):
+    def helper(x:Tensor) -> Tensor: return w @ x
+    def step(x:Tensor) -> Tensor: return (helper(x) * Tensor([1., 2., 3.])).realize()
+    def direct(x:Tensor) -> Tensor: return (w @ x * Tensor([1., 2., 3.])).realize()
+    for fxn,expected in [(step, [w.uop.buffer]), (direct, [])]:
+      jit = TinyJit(fxn)
+      for _ in range(3): jit(Tensor.ones(4).contiguous().realize())
+      self.assertEqual(unknown_buffers(jit.captured, jit_params(fxn, ())), expected)
+
+  def test_capture_references_params(self):
+    unused, w = Tensor.ones(4).contiguous(), Tensor.ones(256, 1024).contiguous().realize()
+    jit = TinyJit(lambda x: (w @ x).realize() if unused is not None else None)
+    for _ in range(3): jit(Tensor.ones(1024).contiguous().realize())
+    _JitPickler(f:=io.BytesIO(), params:=jit_params(jit.fxn, ())).dump(jit.captured)
+    self.assertEqual(params, [unused, w])
+    self.assertLess(len(f.getvalue()), w.nbytes()//10)
+    self.assertIs(_JitUnpickler(io.BytesIO(f.getvalue()), params).load().jit_cache[0].bufs[1], w.uop.buffer)
+    # only the params the capture uses are realized
+    self.assertFalse(unused.uop.is_realized)
+    # a param that doesn't match is an error, the capture isn't used
+    with self.assertRaises(pickle.UnpicklingError): _JitUnpickler(io.BytesIO(f.getvalue()), [unused, Tensor.ones(3).contiguous()]).load()
+
+  def test_load_not_a_jit(self):
+    with tempfile.TemporaryDirectory() as d:
+      with open(fn:=os.path.join(d, "bad.jit"), "wb") as f: pickle.dump((VERSION, 3), f)
+      with self.assertRaises(TypeError): load_jit(fn)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
-import unittest, os, subprocess, sys
+import unittest, os, subprocess, sys, pickle
+from unittest.mock import patch
 from tinygrad import Tensor
-from tinygrad.device import Device, Compiler
-from tinygrad.helpers import diskcache_get, diskcache_put, getenv, Context
+from tinygrad.device import Device, Compiler, src_hash, compile_cache_rekey, SRC_HASH_VERSION
+from tinygrad.helpers import diskcache_get, diskcache_put, getenv, Context, db_connection, VERSION
 
 class TestDevice(unittest.TestCase):
   def test_canonicalize(self):
@@ -34,18 +35,46 @@ class MockCompiler(Compiler):
 
 class TestCompiler(unittest.TestCase):
   def test_compile_cached(self):
-    diskcache_put("key", "123", None) # clear cache
+    diskcache_put("key", src_hash("123"), None) # clear cache
     getenv.cache_clear()
     with Context(DISABLE_COMPILER_CACHE=0):
       self.assertEqual(MockCompiler("key").compile_cached("123"), str.encode("123"))
-      self.assertEqual(diskcache_get("key", "123"), str.encode("123"))
+      self.assertEqual(diskcache_get("key", src_hash("123")), str.encode("123"))
 
   def test_compile_cached_disabled(self):
-    diskcache_put("disabled_key", "123", None) # clear cache
+    diskcache_put("disabled_key", src_hash("123"), None) # clear cache
     getenv.cache_clear()
     with Context(DISABLE_COMPILER_CACHE=1):
       self.assertEqual(MockCompiler("disabled_key").compile_cached("123"), str.encode("123"))
-      self.assertIsNone(diskcache_get("disabled_key", "123"))
+      self.assertIsNone(diskcache_get("disabled_key", src_hash("123")))
+
+  def test_compile_cached_collision(self):
+    # a colliding entry stored with its source isn't returned for a different source
+    diskcache_put("collision_key", src_hash("123"), ("456", b"456"))
+    getenv.cache_clear()
+    with Context(DISABLE_COMPILER_CACHE=0):
+      self.assertEqual(MockCompiler("collision_key").compile_cached("123"), str.encode("123"))
+
+  def test_compile_cached_migrate(self):
+    conn = db_connection()
+    conn.execute(f"DROP TABLE IF EXISTS 'migrate_key_{VERSION}'")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS 'migrate_key_{VERSION-1}' (key text, val blob, PRIMARY KEY (key))")
+    conn.execute(f"REPLACE INTO 'migrate_key_{VERSION-1}' (key, val) VALUES (?, ?)", ("old src", pickle.dumps(b"old lib")))
+    conn.commit()
+    getenv.cache_clear()
+    with Context(DISABLE_COMPILER_CACHE=0):
+      self.assertEqual(MockCompiler("migrate_key").compile_cached("old src"), b"old lib")
+
+  def test_compile_cached_migrate_rekey(self):
+    # only the keys from before SRC_HASH_VERSION are the source, later ones are already hashed
+    self.assertEqual(compile_cache_rekey(SRC_HASH_VERSION-1)("src"), src_hash("src"))
+    self.assertEqual(compile_cache_rekey(SRC_HASH_VERSION)(src_hash("src")), src_hash("src"))
+
+  def test_compile_cached_migrate_cachelevel(self):
+    # without a cache, the first compile doesn't open the cache db
+    getenv.cache_clear()
+    with Context(DISABLE_COMPILER_CACHE=0, CACHELEVEL=0), patch("tinygrad.helpers.db_connection", side_effect=AssertionError("opened db")):
+      self.assertEqual(MockCompiler("nocache_key").compile_cached("src"), b"src")
 
   def test_device_compile(self):
     getenv.cache_clear()
@@ -1,6 +1,9 @@
-import unittest
+import unittest, os, time, tempfile
 import pickle
-from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear
+from tinygrad.helpers import diskcache_get, diskcache_put, diskcache, diskcache_clear, diskcache_evict, db_connection, getenv, Context, VERSION
+from tinygrad.helpers import diskcache_flush, diskcache_migrate, wait_cond, diskcache_stats, diskcache_record, diskcache_export, diskcache_mount
+from unittest.mock import patch
+from tinygrad import helpers
 
 def remote_get(table,q,k): q.put(diskcache_get(table, k))
 def remote_put(table,k,v): diskcache_put(table, k, v)
@@ -81,6 +84,169 @@ class DiskCache(unittest.TestCase):
     diskcache_put(table, "key", "test")
     self.assertEqual(diskcache_get(table, "key"), "test")
 
+  def _set_atime(self, table, key, atime):
+    db_connection().execute(f"UPDATE '{table}_{VERSION}' SET atime=? WHERE key=?", (atime, key))
+    db_connection().commit()
+
+  def test_evict_table_lru(self):
+    table = "test_evict_table_lru"
+    for i in range(4):
+      diskcache_put(table, f"k{i}", b"x"*1000)
+      self._set_atime(table, f"k{i}", i+1)
+    os.environ["CACHESIZE_TEST_EVICT_TABLE_LRU"] = "2500"
+    getenv.cache_clear()
+    try: diskcache_evict(max_bytes=0, ttl=0)
+    finally:
+      del os.environ["CACHESIZE_TEST_EVICT_TABLE_LRU"]
+      getenv.cache_clear()
+    self.assertEqual([diskcache_get(table, f"k{i}") is None for i in range(4)], [True, True, False, False])
+
+  def test_evict_ttl(self):
+    table = "test_evict_ttl"
+    diskcache_put(table, "old", "a")
+    diskcache_put(table, "new", "b")
+    self._set_atime(table, "old", 0)
+    diskcache_evict(max_bytes=0, ttl=int(time.time())-1)
+    self.assertIsNone(diskcache_get(table, "old"))
+    self.assertEqual(diskcache_get(table, "new"), "b")
+
+  def _tables(self): return [x[0] for x in db_connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+
+  def test_evict_stale_version(self):
+    conn = db_connection()
+    conn.execute(f"DROP TABLE IF EXISTS 'test_evict_pending_migration_{VERSION}'")
+    for name in [f"test_evict_stale_version_{VERSION-2}", f"test_evict_pending_migration_{VERSION-1}"]:
+      conn.execute(f"CREATE TABLE IF NOT EXISTS '{name}' (key text, val blob, PRIMARY KEY (key))")
+      conn.execute(f"REPLACE INTO '{name}' VALUES (?, ?)", ("k", pickle.dumps(b"x"*1000)))
+    # a cache.db from before auto_vacuum was set
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum=NONE")
+    conn.execute("VACUUM")
+    self.assertGreaterEqual(diskcache_evict(max_bytes=0, ttl=0), 1)
+    self.assertNotIn(f"test_evict_stale_version_{VERSION-2}", self._tables())
+    self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+    # the last VERSION is kept until it's migrated
+    self.assertIn(f"test_evict_pending_migration_{VERSION-1}", self._tables())
+    self.assertEqual(diskcache_migrate("test_evict_pending_migration", VERSION-1, lambda k: k+"!"), 1)
+    self.assertEqual(diskcache_get("test_evict_pending_migration", "k!"), b"x"*1000)
+    diskcache_evict(max_bytes=0, ttl=0)
+    self.assertNotIn(f"test_evict_pending_migration_{VERSION-1}", self._tables())
+
+  def test_migrate_one_transaction(self):
+    conn = db_connection()
+    conn.execute(f"DROP TABLE IF EXISTS 'test_migrate_one_transaction_{VERSION}'")
+    conn.execute(f"DROP TABLE IF EXISTS 'test_migrate_one_transaction_{VERSION-1}'")
+    conn.execute(f"CREATE TABLE 'test_migrate_one_transaction_{VERSION-1}' (key text, val blob, PRIMARY KEY (key))")
+    conn.executemany(f"INSERT INTO 'test_migrate_one_transaction_{VERSION-1}' VALUES (?, ?)", [(str(i), pickle.dumps(i)) for i in range(1000)])
+    conn.commit()
+    # the rows are copied in sqlite, not put one by one
+    with patch.object(helpers, "diskcache_put", side_effect=AssertionError("put a row")):
+      self.assertEqual(diskcache_migrate("test_migrate_one_transaction", VERSION-1, lambda k: f"new {k}"), 1000)
+    self.assertEqual([diskcache_get("test_migrate_one_transaction", f"new {i}") for i in (0, 999)], [0, 999])
+    # a second migration doesn't copy again
+    self.assertEqual(diskcache_migrate("test_migrate_one_transaction", VERSION-1, lambda k: f"new {k}"), 0)
+
+  def test_get_touches_atime(self):
+    table = "test_get_touches_atime"
+    diskcache_put(table, "k", "v")
+    self._set_atime(table, "k", 0)
+    with Context(CACHETTL=int(time.time())-1):
+      self.assertEqual(diskcache_get(table, "k"), "v")
+      self.assertEqual(diskcache_get(table, "k"), "v")
+    self.assertGreater(db_connection().execute(f"SELECT atime FROM '{table}_{VERSION}'").fetchone()[0], 0)
+
+  def test_put_evicts_opportunistically(self):
+    table = "test_put_evicts_opportunistically"
+    diskcache_put(table, "old", "a")
+    self._set_atime(table, "old", 0)
+    with Context(CACHETTL=int(time.time())-1):
+      for i in range(helpers.EVICT_INTERVAL): diskcache_put(table, f"k{i}", i)
+    self.assertIsNone(diskcache_get(table, "old"))
+
+  def _in_db(self, table, key):
+    try: return db_connection().execute(f"SELECT val FROM '{table}_{VERSION}' WHERE key=?", (key,)).fetchone() is not None
+    except Exception: return False
+
+  def _drop(self, table):
+    db_connection().execute(f"DROP TABLE IF EXISTS '{table}_{VERSION}'")
+    helpers._db_tables.discard(table)
+
+  def test_batched_put(self):
+    self._drop(table:="test_batched_put")
+    with Context(CACHE_BATCH=100):
+      for i in range(10): diskcache_put(table, f"k{i}", i)
+      # read your writes before the flush
+      self.assertEqual([diskcache_get(table, f"k{i}") for i in range(10)], list(range(10)))
+      self.assertFalse(self._in_db(table, "k0"))
+      diskcache_flush()
+    self.assertTrue(all(self._in_db(table, f"k{i}") for i in range(10)))
+    self.assertEqual(diskcache_get(table, "k9"), 9)
+
+  def test_batched_put_flushes_when_full(self):
+    self._drop(table:="test_batched_put_flushes_when_full")
+    with Context(CACHE_BATCH=4):
+      for i in range(4): diskcache_put(table, f"k{i}", i)
+    self.assertTrue(all(self._in_db(table, f"k{i}") for i in range(4)))
+
+  def test_async_put(self):
+    self._drop(table:="test_async_put")
+    with Context(CACHE_ASYNC=1, CACHE_BATCH=1):
+      diskcache_put(table, "k", "async")
+      self.assertEqual(diskcache_get(table, "k"), "async")
+    wait_cond(lambda: self._in_db(table, "k"), msg="background writer didn't flush")
+    self.assertEqual(diskcache_get(table, "k"), "async")
+
+  def test_mem_cache(self):
+    table = "test_mem_cache"
+    diskcache_put(table, "k", ("mem", 1))
+    self.assertEqual(diskcache_get(table, "k"), ("mem", 1))
+    hits = diskcache_stats["mem_hits"]
+    with patch.object(helpers, "db_connection", side_effect=AssertionError("shouldn't hit sqlite")):
+      self.assertEqual(diskcache_get(table, "k"), ("mem", 1))
+    self.assertEqual(diskcache_stats["mem_hits"], hits+1)
+    # a put replaces the cached value
+    diskcache_put(table, "k", ("mem", 2))
+    self.assertEqual(diskcache_get(table, "k"), ("mem", 2))
+
+  def test_mem_cache_copies(self):
+    table = "test_mem_cache_copies"
+    diskcache_put(table, "k", [1, 2])
+    diskcache_get(table, "k").append(3)
+    self.assertEqual(diskcache_get(table, "k"), [1, 2])
+    diskcache_get(table, "k").append(3)
+    self.assertEqual(diskcache_get(table, "k"), [1, 2])
+
+  def test_mem_cache_bounded(self):
+    table = "test_mem_cache_bounded"
+    with Context(CACHE_MEM_SIZE=2500):
+      for i in range(4): diskcache_put(table, f"k{i}", b"x"*1000)
+      for i in range(4): diskcache_get(table, f"k{i}")
+      self.assertLessEqual(helpers._db_mem_size, 2500)
+      self.assertNotIn(helpers._mem_key(table, {"key": "k0"}), helpers._db_mem)
+      self.assertIn(helpers._mem_key(table, {"key": "k3"}), helpers._db_mem)
+
+  def test_export_mount_bundle(self):
+    table = "test_export_mount_bundle"
+    diskcache_put(table, "used", "bundled")
+    diskcache_put(table, "unused", "local only")
+    with diskcache_record() as rows: self.assertEqual(diskcache_get(table, "used"), "bundled")
+    with tempfile.TemporaryDirectory() as tmp:
+      self.assertEqual(diskcache_export(fn:=os.path.join(tmp, "bundle.db"), rows), 1)
+      self._drop(table)
+      helpers._mem_clear()
+      self.assertIsNone(diskcache_get(table, "used"))
+      diskcache_mount(fn)
+      try:
+        self.assertEqual(diskcache_get(table, "used"), "bundled")
+        self.assertIsNone(diskcache_get(table, "unused"))
+        # writes go to the local cache, the bundle is read-only
+        diskcache_put(table, "new", "local")
+        self.assertEqual(diskcache_get(table, "new"), "local")
+      finally:
+        helpers.diskcache_bundles.remove(fn)
+        for conn in helpers._db_local.bundles.values(): conn.close()
+        helpers._db_local.bundles.clear()
+
   @unittest.skip("disabled by default because this drops cache table")
   def test_clear_cache(self):
     # clear cache to start
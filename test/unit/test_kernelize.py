@@ -1,6 +1,8 @@
 import unittest
-from tinygrad import Tensor
+from tinygrad import Tensor, TinyJit
 from tinygrad.uop import Ops
+from tinygrad.helpers import Context
+from tinygrad.schedule.kernelize import kernelize_cache
 
 class TestKernelize(unittest.TestCase):
   def test_add_reshaped(self):
@@ -29,5 +31,40 @@ class TestKernelize(unittest.TestCase):
     # the input to the REDUCE_AXIS is an ASSIGN though
     self.assertIs(a1.uop.base.src[0].base.op, Ops.ASSIGN)
 
+  @Context(SCHEDULE_CACHE=64)
+  def test_structural_cache(self):
+    w = Tensor([[1.,2],[3,4]]).realize()
+    rets, entries = [], []
+    for x in [[1.,0],[0.,1],[2.,2]]:
+      ret = (Tensor(x).realize() @ w).relu() + 1
+      rets.append(ret.realize())
+      entries.append(len(kernelize_cache))
+    # the inputs are placeholders, so the same graph with other buffers is a hit
+    self.assertEqual(entries[0], entries[-1])
+    self.assertEqual([r.tolist() for r in rets], [[2.,3.], [4.,5.], [9.,13.]])
+    # each hit gets new output buffers
+    self.assertEqual(len(set(r.uop.buffer for r in rets)), 3)
+    entries.append(len(kernelize_cache))
+    with Context(SCHEDULE_CACHE=0):
+      (Tensor([5.,5]).realize() @ w*3).realize()
+    self.assertEqual(len(kernelize_cache), entries[-1])
+
+  @Context(SCHEDULE_CACHE=64)
+  def test_structural_cache_jit_manual_seed(self):
+    # the random counter is assigned in every call, a second jit after manual_seed must give the same numbers
+    def f(a):
+      rn = Tensor.randn(*a.shape) * a
+      rn2 = Tensor.randn(*a.shape) + rn
+      return (a*rn).realize(), (a*(rn2+Tensor.randn(*a.shape))).realize()
+    a = Tensor.ones(4, 4).contiguous().realize()
+    rets = []
+    for _ in range(2):
+      Tensor.manual_seed(1234)
+      jf = TinyJit(f)
+      rets.append([[o.tolist() for o in jf(a)] for _ in range(4)])
+    self.assertEqual(rets[0], rets[1])
+    # the calls after the capture don't repeat the numbers
+    self.assertNotEqual(rets[0][1], rets[0][2])
+
 if __name__ == '__main__':
   unittest.main()
@@ -1,6 +1,9 @@
 import unittest
-from tinygrad import Tensor
+from tinygrad import Tensor, Context
+from tinygrad.helpers import ScheduleTiming, cpu_events
 from tinygrad.uop.ops import Ops
+from tinygrad.engine.realize import run_schedule
+from tinygrad.engine.schedule import create_schedule_with_vars
 
 class TestSimpleSchedule(unittest.TestCase):
   def test_reduce_doesnt_split(self):
@@ -11,5 +14,62 @@ class TestSimpleSchedule(unittest.TestCase):
     kernels = [x for x in a1.uop.sink(a2.uop).toposort() if x.op is Ops.KERNEL]
     self.assertEqual(len(kernels), 1)
 
+  def test_schedule_timing(self):
+    a = Tensor.empty(16,16)
+    with Context(SCHEDULE_CACHE=0), ScheduleTiming() as t: ((a+2)*3).sum(axis=1).schedule()
+    passes = t.as_dict()
+    for name in ["kernelize", "kernelize/merge_views", "kernelize/grouper", "kernelize/create_ast", "create_schedule_with_vars", "memory_planner"]:
+      self.assertEqual(passes[name]["calls"], 1)
+    # nested passes count in the outer pass
+    self.assertGreater(passes["kernelize"]["uops"], passes["kernelize/merge_views"]["uops"])
+    self.assertGreaterEqual(passes["kernelize"]["ms"], passes["kernelize/create_ast"]["ms"])
+    self.assertEqual({k.split("/")[0] for k in passes}, {"kernelize", "remove_assigns", "create_schedule_with_vars", "memory_planner"})
+
+  def test_schedule_timing_profile(self):
+    cpu_events.clear()
+    with Context(SCHEDULE_CACHE=0, PROFILE=1): (Tensor.empty(16,16)*4).sum(axis=0).schedule()
+    self.assertIn("kernelize/create_ast", [e.name for e in cpu_events])
+    cpu_events.clear()
+
+class TestScheduleOrder(unittest.TestCase):
+  def test_memory_order(self):
+    def peak(order:int) -> int:
+      out = (Tensor.empty(1024, 1024)+1).contiguous().sum() + (Tensor.empty(1024, 1024)*2).contiguous().sum()
+      with Context(SCHEDULE_ORDER=order, NO_MEMORY_PLANNER=1): sched = out.schedule()
+      # the output of each kernel is live from the kernel to its last reader
+      last = {b:i for i,si in enumerate(sched) for b in si.bufs}
+      return max(sum(si.bufs[0].nbytes for si in sched[:i+1] if last[si.bufs[0]] >= i) for i in range(len(sched)))
+    # the big contiguous buffers aren't live at the same time
+    self.assertLess(peak(1), 2*1024*1024*4)
+    self.assertLessEqual(peak(1), peak(0))
+
+  def test_critical_path_order(self):
+    def order(order:int) -> list[bool]:
+      a = (Tensor.empty(16)+1).contiguous()
+      c = ((a*2).contiguous()+3).contiguous()
+      d = (Tensor.empty(16)*5).contiguous()
+      with Context(SCHEDULE_ORDER=order): sched = Tensor.schedule(c, d)
+      return [si.bufs[0] is d.uop.buffer for si in sched]
+    self.assertEqual(order(0), [False, True, False, False])
+    # d isn't on the chain of a, so it's last
+    self.assertEqual(order(2), [False, False, False, True])
+
+  def test_read_then_assign(self):
+    for order in range(3):
+      a = Tensor.ones(4).contiguous().realize()
+      b = (a+1).contiguous()
+      c = (a.assign(a*3)*2).contiguous()
+      # b reads a before the assign writes it, even if the assign is on a longer path
+      with Context(SCHEDULE_ORDER=order): sched = Tensor.schedule(b, c)
+      self.assertEqual([si.bufs[0] is a.uop.buffer for si in sched], [False, True, False])
+      run_schedule(sched)
+      self.assertEqual((a.tolist(), b.tolist(), c.tolist()), ([3.]*4, [2.]*4, [6.]*4))
+
+  def test_order_missing_kernels(self):
+    a = Tensor.ones(4).contiguous().realize()
+    a.assign(a*3)
+    # an order that leaves out kernels is an error
+    with self.assertRaises(AssertionError): create_schedule_with_vars(a.kernelize().uop.sink(), order=lambda children,in_degree,sink: [])
+
 if __name__ == '__main__':
   unittest.main()
@@ -84,9 +84,14 @@ class TransformerBlock:
     v = self.cache_kv[1, :, :, 0:start_pos+T, :]
 
     # NOTE: this mask is causal_lower_right, not the causal_upper_left generated by is_casual = True
-    mask = Tensor.full((1, 1, T, start_pos+T), float("-inf"), dtype=x.dtype, device=x.device).triu(start_pos+1) if T > 1 else None
+    if isinstance(T, int):
+      mask = Tensor.full((1, 1, T, start_pos+T), float("-inf"), dtype=x.dtype, device=x.device).triu(start_pos+1) if T > 1 else None
+    else:
+      # triu doesn't support a symbolic T (prefill in the JIT), so compare the positions
+      cols, rows = Tensor.arange(start_pos+T, device=x.device), Tensor.arange(T, device=x.device)[:, None]
+      mask = (cols > rows+start_pos).where(float("-inf"), 0.).cast(x.dtype).reshape(1, 1, T, start_pos+T)
     attn = q.scaled_dot_product_attention(k, v, attn_mask=mask, enable_gqa=True)     # (B,H,T,Hd)
-    attn = attn.transpose(1, 2).reshape(B, T, -1)                                    # back to (B,T,D)
+    attn = attn.transpose(1, 2).reshape(B, T, self.n_heads*self.head_dim)           # back to (B,T,D)
     attn = self.attn_output(attn)
     return x + attn
 
@@ -105,8 +110,8 @@ class Transformer:
     self.output_norm = nn.RMSNorm(dim, norm_eps)
     self.output = nn.Linear(dim, vocab_size, bias=False)
     self.max_context = max_context
-    # JIT is used if T=1 and start_pos is a UOp. TODO: make this not needed by including T in the JIT and making start_pos always a UOp
-    self.forward_jit = TinyJit(self.forward)
+    # JIT is used if start_pos is a UOp and T is 1 (decode) or a UOp (prefill), each has its own capture
+    self.forward_jit = TinyJit(self.forward, max_captures=2)
 
   def forward(self, tokens:Tensor, start_pos:int|UOp) -> Tensor:
     x = self.token_embd(tokens)                           # (B, T, D)
@@ -115,7 +120,8 @@ class Transformer:
     return self.output(self.output_norm(x))[:, -1, :].softmax(-1).argmax(-1, keepdim=True)
 
   def __call__(self, tokens:Tensor, start_pos:int|UOp=0) -> Tensor:
-    return (self.forward_jit if getenv("JIT", 1) and tokens.shape[1] == 1 and isinstance(start_pos, UOp) else self.forward)(tokens, start_pos)
+    use_jit = getenv("JIT", 1) and isinstance(start_pos, UOp) and (tokens.shape[1] == 1 or isinstance(tokens.shape[1], UOp))
+    return (self.forward_jit if use_jit else self.forward)(tokens, start_pos)
 
   @staticmethod
   def from_gguf(gguf:Tensor, max_context:int|None=None) -> tuple[Transformer, dict]:
@@ -137,12 +143,14 @@ class Transformer:
     return model, kv
 
   def generate(self, tokens:list[int], start_pos=0):
-    v_start_pos = UOp.variable("start_pos", 1, self.max_context-1)
+    v_start_pos, v_toks = UOp.variable("start_pos", 0, self.max_context-1), UOp.variable("toks", 1, self.max_context)
     start_pos = 0
-    t = Tensor([tokens[start_pos:]], dtype="int32")
-    self.forward_jit.reset()  # TODO: why is this required? root cause the issue and make it not be needed
+    # with SYM, prefill has a symbolic length and the tokens are padded to max_context, so one captured JIT runs prompts of any length
+    if getenv("SYM", 1) and (T:=len(tokens)-start_pos) > 1:
+      t = Tensor([tokens[start_pos:] + [0]*(self.max_context-T)], dtype="int32")[:, :v_toks.bind(T)]
+    else: t = Tensor([tokens[start_pos:]], dtype="int32")
     while len(tokens) < self.max_context:
-      t = self(t, v_start_pos.bind(start_pos) if getenv("SYM", 1) and start_pos != 0 and t.shape[-1] == 1 else start_pos)
+      t = self(t, v_start_pos.bind(start_pos) if getenv("SYM", 1) else start_pos)
       next_id = int(t.item())
       tokens.append(next_id)
       start_pos = len(tokens) - 1
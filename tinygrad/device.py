@@ -1,10 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass, replace, field
 from collections import defaultdict
-from typing import Any, Generic, TypeVar, Iterator
-import importlib, inspect, functools, pathlib, os, platform, contextlib, sys, re, atexit, pickle, decimal, time
+from typing import Any, Generic, TypeVar, Iterator, Callable
+import importlib, inspect, functools, pathlib, os, platform, contextlib, sys, re, atexit, pickle, decimal, time, hashlib
 from tinygrad.helpers import CI, OSX, LRU, getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, PROFILE, temp, \
-                             colored, Context, DISABLE_COMPILER_CACHE, ALLOW_DEVICE_USAGE, cpu_events, ProfileEvent, dedup
+                             colored, Context, DISABLE_COMPILER_CACHE, ALLOW_DEVICE_USAGE, cpu_events, ProfileEvent, dedup, diskcache_migrate, \
+                             VERSION, CACHELEVEL
 from tinygrad.dtype import DType, ImageDType, PtrDType, dtypes, _to_np_dtype
 from tinygrad.renderer import Renderer
 
@@ -265,19 +266,35 @@ class LRUAllocator(Allocator, Generic[DeviceType]):
 
 class CompileError(Exception): pass
 
+def src_hash(src:str) -> str: return hashlib.sha256(src.encode()).hexdigest()
+
+# compile caches before this VERSION were keyed by the full source, from it on they're keyed by src_hash
+SRC_HASH_VERSION = 22
+def compile_cache_rekey(old_version:int) -> Callable[[str], str]: return src_hash if old_version < SRC_HASH_VERSION else lambda k: k
+
+_migrated_cachekeys: set[str] = set()
 class Compiler:
   def __init__(self, cachekey:str|None=None): self.cachekey = None if DISABLE_COMPILER_CACHE else cachekey
   def compile(self, src:str) -> bytes: return src.encode()   # NOTE: empty compiler is the default
   def compile_cached(self, src:str) -> bytes:
-    if self.cachekey is None or (lib := diskcache_get(self.cachekey, src)) is None:
+    # the cache is keyed by a hash of the source. with CHECK_COMPILE_CACHE the source is also stored with the lib to detect collisions
+    if self.cachekey is not None and CACHELEVEL > 0 and self.cachekey not in _migrated_cachekeys:
+      _migrated_cachekeys.add(self.cachekey)
+      diskcache_migrate(self.cachekey, VERSION-1, compile_cache_rekey(VERSION-1))
+    if self.cachekey is None or (lib := self._lib_from_cache(src, diskcache_get(self.cachekey, key:=src_hash(src)))) is None:
       assert not getenv("ASSERT_COMPILE"), f"tried to compile with ASSERT_COMPILE set\n{src}"
       lib = self.compile(src)
-      if self.cachekey is not None: diskcache_put(self.cachekey, src, lib)
+      if self.cachekey is not None: diskcache_put(self.cachekey, key, (src, lib) if getenv("CHECK_COMPILE_CACHE") else lib)
     return lib
+  @staticmethod
+  def _lib_from_cache(src:str, ret:bytes|tuple[str, bytes]|None) -> bytes|None:
+    if isinstance(ret, tuple): return ret[1] if ret[0] == src else None
+    return ret
   def disassemble(self, lib:bytes): pass
 
 class Compiled:
   profile_events:list[ProfileEvent] = [ProfileDeviceEvent("CPU")] # NOTE: CPU is the default device.
+  threadsafe_runtime:bool = False  # programs can be loaded from another thread while this device runs kernels
 
   def __init__(self, device:str, allocator:Allocator, renderer:Renderer|None, compiler:Compiler|None, runtime, graph=None, group_id=None):
     self.device, self.allocator, self.compiler, self.runtime, self.graph = device, allocator, compiler or Compiler(), runtime, graph
@@ -0,0 +1,118 @@
+# ahead-of-time compile a TinyJit function into a file that can be served without the model code
+# usage: python3 -m tinygrad.engine.aot <module>:<jit function> <module>:<example inputs function> <out.jit>
+import sys, pickle, importlib, inspect, hashlib, io, types
+from typing import Callable, Any, cast
+from tinygrad.tensor import Tensor
+from tinygrad.engine.jit import TinyJit, CapturedJit, get_out_buffers_for_ei
+from tinygrad.engine.realize import ViewOp
+from tinygrad.helpers import JIT, DEBUG, VERSION, Context, diskcache_get, diskcache_put
+from tinygrad.device import Buffer, MultiBuffer
+from tinygrad.nn.state import get_parameters
+from tinygrad.uop.ops import UOp, Ops
+
+def export_jit(fxn:TinyJit, fn:str, example_inputs:Callable[[], tuple[Any, ...]]) -> TinyJit:
+  """Captures fxn by calling it on example_inputs() until it's jitted, then writes the CapturedJit with its compiled programs and weights to fn."""
+  assert JIT, "export_jit needs JIT enabled"
+  while fxn.captured is None: fxn(*example_inputs())
+  with open(fn, "wb") as f: pickle.dump((VERSION, fxn), f)
+  if DEBUG >= 1: print(f"exported {len(fxn.jit_cache)} kernels to {fn}")
+  return fxn
+
+def _param_buffers(t:Tensor) -> list[Buffer]:
+  return [] if (rb:=t.uop.base.realized) is None else rb.bufs if isinstance(rb, MultiBuffer) else [rb]
+
+class _JitPickler(pickle.Pickler):
+  # the params are written as their index and the index of the buffer in the param, not their data
+  def __init__(self, f, params:list[Tensor]):
+    super().__init__(f)
+    self.params = {b:(i,j) for i,t in enumerate(params) for j,b in enumerate(_param_buffers(t))}
+  def persistent_id(self, obj):
+    if isinstance(obj, Buffer) and (ij:=self.params.get(obj)) is not None: return (*ij, obj.device, obj.size, obj.dtype)
+    return None
+
+class _JitUnpickler(pickle.Unpickler):
+  def __init__(self, f, params:list[Tensor]|None=None):
+    super().__init__(f)
+    self.uniques: dict[int, UOp] = {}
+    self.params = params or []
+  def find_class(self, module, name): return self._uop if (module, name) == ("tinygrad.uop.ops", "UOp") else super().find_class(module, name)
+  def _uop(self, op:Ops, *args) -> UOp:
+    # UOps are deduped by value, so the loaded buffers get fresh UNIQUEs to not alias the tensors of this process
+    return self.uniques.setdefault(args[2], UOp.unique()) if op is Ops.UNIQUE else UOp(op, *args)
+  def persistent_load(self, pid):
+    i, j, *desc = pid
+    if i >= len(self.params): raise pickle.UnpicklingError(f"param {i} doesn't exist")
+    # only the params the capture uses are realized
+    if not (t:=self.params[i]).uop.is_realized: t.realize()
+    if j >= len(bufs:=_param_buffers(t)) or [(b:=bufs[j]).device, b.size, b.dtype] != desc:
+      raise pickle.UnpicklingError(f"param {i} doesn't match {desc}")
+    return b
+
+def load_jit(fn:str, prewarm=False) -> TinyJit:
+  """
+  Loads a TinyJit written by export_jit. Nothing is traced, scheduled or compiled, so it must run on the devices it was exported on.
+  Programs are loaded on the device when first used, with prewarm a background thread loads the rest meanwhile (see CapturedJit.prewarm).
+  """
+  # NOTE: this is a pickle, only load files you trust
+  with open(fn, "rb") as f, Context(LAZY_PROGRAMS=1): version, fxn = _JitUnpickler(f).load()
+  if version != VERSION: raise RuntimeError(f"{fn} was exported with cache version {version}, this tinygrad is {VERSION}")
+  if not isinstance(fxn, TinyJit): raise TypeError(f"{fn} doesn't contain a TinyJit, got {type(fxn)}")
+  if prewarm and fxn.captured is not None: fxn.captured.prewarm()
+  return fxn
+
+# *** keyed persistence of the captures of TinyJit(cache_key=...) ***
+
+def jit_params(fxn:Callable, args:tuple) -> list[Tensor]:
+  """The weights fxn can reach: from the object it's bound to, its closure, the globals it uses and its non Tensor args. They aren't realized."""
+  fxn = inspect.unwrap(fxn)
+  objs = [getattr(fxn, "__self__", None)] + [x for x in args if not isinstance(x, Tensor)]
+  if (code:=getattr(fxn:=getattr(fxn, "__func__", fxn), "__code__", None)) is not None:
+    objs += [c.cell_contents for c in fxn.__closure__ or ()] + [fxn.__globals__[n] for n in code.co_names if n in fxn.__globals__]
+  return get_parameters([x for x in objs if not isinstance(x, (types.ModuleType, type, types.FunctionType, TinyJit))])
+
+def capture_key(cache_key:str, fxn:Callable, signature:tuple) -> dict[str, str]:
+  """The key of a capture. NOTE: only the source of fxn itself is hashed, not the source of the functions it calls."""
+  try: src = inspect.getsource(inspect.unwrap(fxn)).encode()
+  except (OSError, TypeError): src = getattr(getattr(fxn, "__func__", fxn), "__code__").co_code
+  return {"key": cache_key, "src": hashlib.sha256(src).hexdigest(), "signature": hashlib.sha256(str(signature).encode()).hexdigest()}
+
+def unknown_buffers(captured:CapturedJit, params:list[Tensor]) -> list[Buffer]:
+  """The buffers the capture reads before it writes them that aren't inputs or params, like the weights of a model fxn uses through a helper."""
+  known: set[Buffer] = {b for t in params for b in _param_buffers(t)}
+  unknown: list[Buffer] = []
+  for ei in captured.jit_cache:
+    if isinstance(ei.prg, ViewOp):
+      if ei.bufs[1] in known: known.add(cast(Buffer, ei.bufs[0]))
+      continue
+    outs = get_out_buffers_for_ei(ei)
+    # the inputs were cleared from the jit cache, they are None. host buffers are the data of Tensors fxn creates, like Tensor([1., 2.])
+    unknown += [b for b in ei.bufs if b is not None and b not in known and b not in outs and b not in unknown and b.device not in {"PYTHON", "NPY"}]
+    known.update(outs)
+  return unknown
+
+def save_capture(key:dict[str, str], captured:CapturedJit, params:list[Tensor]):
+  # a buffer that isn't a param would be pickled by value, and the next process would replay its stale data
+  if len(unknown:=unknown_buffers(captured, params)):
+    if DEBUG >= 1: print(f"JIT didn't save the capture for {key['key']}, it reads {len(unknown)} buffers that aren't inputs or params of fxn")
+    return
+  _JitPickler(f:=io.BytesIO(), params).dump(captured)
+  diskcache_put("jit_capture", key, f.getvalue())
+  if DEBUG >= 1: print(f"JIT saved {len(captured.jit_cache)} kernels for {key['key']}, {len(f.getvalue())/1e6:.2f} MB")
+
+def load_capture(key:dict[str, str], params:Callable[[], list[Tensor]]) -> CapturedJit|None:
+  if (data:=diskcache_get("jit_capture", key)) is None: return None
+  try:
+    with Context(LAZY_PROGRAMS=1): captured = _JitUnpickler(io.BytesIO(data), params()).load()
+  except pickle.UnpicklingError as e:
+    if DEBUG >= 1: print(f"JIT didn't load the capture for {key['key']}: {e}")
+    return None
+  if DEBUG >= 1: print(f"JIT loaded {len(captured.jit_cache)} kernels for {key['key']}")
+  return captured
+
+def _import(name:str) -> Any:
+  mod, attr = name.split(":")
+  return getattr(importlib.import_module(mod), attr)
+
+if __name__ == "__main__":
+  if len(sys.argv) != 4: raise SystemExit(f"usage: {sys.argv[0]} <module>:<jit function> <module>:<example inputs function> <out.jit>")
+  export_jit(_import(sys.argv[1]), sys.argv[3], _import(sys.argv[2]))
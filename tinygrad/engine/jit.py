@@ -1,12 +1,13 @@
 from typing import TypeVar, Generic, Callable, cast, Any
-import functools, collections
+import functools, collections, threading
 from tinygrad.tensor import Tensor
-from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, JIT_BATCH_SIZE, dedup, partition, unwrap
+from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, JIT_BATCH_SIZE, dedup, partition, unwrap, all_int
+from tinygrad.helpers import GlobalCounters, CAPTURING
 from tinygrad.device import Buffer, Compiled, Device, MultiBuffer
-from tinygrad.dtype import DType
+from tinygrad.dtype import DType, DTypeLike, dtypes, to_dtype
 from tinygrad.uop.ops import UOp, Variable, sym_infer, Ops
 from tinygrad.shape.shapetracker import ShapeTracker
-from tinygrad.engine.realize import ExecItem, capturing, ViewOp, BufferCopy, BufferXfer, CompiledRunner, Runner, Estimates
+from tinygrad.engine.realize import ExecItem, capturing, ViewOp, BufferCopy, BufferXfer, CompiledRunner, Runner, Estimates, HostCallback
 from tinygrad.engine.memory import _internal_memory_planner
 from tinygrad.nn.state import get_parameters
 from dataclasses import dataclass
@@ -136,7 +137,7 @@ class MultiGraphRunner(GraphRunner):
 
 def get_out_buffers_for_ei(ei:ExecItem) -> list[Buffer]:
   if isinstance(ei.prg, CompiledRunner): return [cast(Buffer, ei.bufs[out]) for out in ei.prg.p.outs if out not in ei.prg.p.ins]
-  if isinstance(ei.prg, (BufferCopy, BufferXfer)): return [cast(Buffer, ei.bufs[0])]
+  if isinstance(ei.prg, (BufferCopy, BufferXfer, HostCallback)): return [cast(Buffer, ei.bufs[0])]
   return []
 
 def update_depends(depends:set[Buffer|None], jit_cache:list[ExecItem]):
@@ -162,6 +163,7 @@ class CapturedJit(Generic[ReturnType]):
     self._jit_cache: list[ExecItem] = self.jit_cache
     self._input_replace: dict[tuple[int, int], int] = self.input_replace
     self._first_run = True
+    self._plan: list[ExecItem|tuple[Any, list, dict[str, tuple[int, ...]], tuple[Variable, ...]]]|None = None
     self._clear_inputs()
 
   def _clear_inputs(self):
@@ -176,16 +178,56 @@ class CapturedJit(Generic[ReturnType]):
         if b._base is not None and b._base.allocated_views == 0 and b._base.is_allocated(): b._base.deallocate()
     self.__post_init__()   # reset the graph state
 
-  def replan_buffers_memory_layout(self):
-    blacklist = [t.uop.buffer for t in get_parameters(self.ret)]
-    asgn = _internal_memory_planner([[b for item in self.jit_cache for b in item.bufs if b is not None and b not in blacklist]], ignore_checks=True)
-    self.jit_cache = [ExecItem(item.prg, [asgn.get(b,b) if b is not None else None for b in item.bufs]) for item in self.jit_cache]
-    for old, new in asgn.items():
-      if old.is_allocated(): new.ensure_allocated().copyin(old.as_buffer())
+  def replan_buffers_memory_layout(self) -> tuple[int, int]:
+    """
+    Plans the intermediates of the jit again from their liveness over the whole jit cache, aliasing them into one arena per device.
+    Params, outputs and buffers read before they are written keep their memory, so nothing is copied. Returns the peak bytes before and after.
+    """
+    # views are made by ViewOps, they keep their root alive and move with it
+    keep = set(flatten([rb.bufs if isinstance(rb:=t.uop.base.realized, MultiBuffer) else [rb] for t in get_parameters(self.ret)]))
+    keep |= {b for ei in self.jit_cache if isinstance(ei.prg, BufferXfer) for b in ei.bufs if b is not None}
+    views: dict[Buffer, Buffer] = {}
+    steps: list[list[Buffer]] = []
+    intermediates: list[Buffer] = []
+    seen: set[Buffer] = set()
+    for ei in self.jit_cache:
+      if isinstance(ei.prg, ViewOp): views[cast(Buffer, ei.bufs[0])] = views.get(src:=cast(Buffer, ei.bufs[1]), src)
+      outs = get_out_buffers_for_ei(ei)
+      for b in ei.bufs:
+        if b is None or (u:=views.get(b, b)) in seen: continue
+        # an intermediate is first written whole by the jit and isn't referenced outside of it
+        if u is b and b in outs and b not in keep and b.uop_refcount == 0: intermediates.append(b)
+        seen.add(u)
+      steps.append([b for b in ei.bufs if b is not None])
+
+    # the intermediates get fresh buffers to plan, graphs order the kernels that share a buffer base so the liveness is kept inside a graph batch
+    fresh = {u:Buffer(u.device, u.size, u.dtype, options=u.options) for u in intermediates}
+    fresh.update({v:Buffer(v.device, v.size, v.dtype, base=fresh[r], offset=v.offset-r.offset) for v,r in views.items() if r in fresh})
+    assigned = _internal_memory_planner([[fresh[b] for b in step if b in fresh] for step in steps], debug_prefix="JIT replan ")
+    replace = {b:assigned.get(f, f) for b,f in fresh.items()}
+    before, after = sum(b.nbytes for b in dedup(u.base for u in intermediates)), sum(b.nbytes for b in dedup(replace[u].base for u in intermediates))
+    if DEBUG >= 1: print(f"JIT replan: peak memory of {len(intermediates)} intermediates {before/1e6:.2f} MB -> {after/1e6:.2f} MB")
+    self.jit_cache = [ExecItem(ei.prg, [replace.get(b,b) if b is not None else None for b in ei.bufs], ei.metadata, ei.fixedvars)
+                      for ei in self.jit_cache]
     self.__post_init__()
+    return before, after
+
+  def prewarm(self) -> threading.Thread:
+    """
+    Loads the programs of a jit unpickled with LAZY_PROGRAMS on a background thread. Calls load what they use first.
+    Only devices with a threadsafe_runtime are prewarmed, others (like HCQ GPUs, which allocate and copy the binary in) load on first use.
+    """
+    runners = dedup([ei.prg for ei in self.jit_cache if isinstance(ei.prg, CompiledRunner) and Device[ei.prg.device].threadsafe_runtime])
+    (t:=threading.Thread(target=lambda: [r.load() for r in runners], name="jit_prewarm", daemon=True)).start()
+    return t
 
   # jit exec
   def __call__(self, input_buffers:list[Buffer], var_vals:dict[Variable, int]) -> ReturnType:
+    # the input positions are found again on the first run, an input that's also a buffer of the jit (like its own output fed back) must be a copy
+    if self._first_run:
+      jit_buffers = set(b for ji in self._jit_cache for b in ji.bufs if b is not None)
+      for k,ib in enumerate(input_buffers):
+        if ib in jit_buffers: input_buffers[k] = Buffer(ib.device, ib.size, ib.dtype, options=ib.options).ensure_allocated().copyin(ib.as_buffer())
     # assign inputs
     for idx, offset, device, size, dtype in self.extra_view_inputs:
       input_buffers.append(Buffer(device, size, dtype, base=input_buffers[idx], offset=offset).ensure_allocated())
@@ -204,10 +246,37 @@ class CapturedJit(Generic[ReturnType]):
       self._first_run = False
 
     if DEBUG >= 1 and len(self._jit_cache) >= 10: print(f"jit execs {len(self._jit_cache)} kernels")
-    for ei in self._jit_cache: ei.run(var_vals, jit=True)
+    if self._plan is not None and DEBUG < 2: self._run_plan(input_buffers, var_vals)
+    else:
+      for ei in self._jit_cache: ei.run(var_vals, jit=True)
+      if self._plan is None: self._build_plan()
     self._clear_inputs()
     return self.ret
 
+  def _build_plan(self):
+    # kernels with int launch dims are called on the runtime program with their raw buffers, the rest (graphs, copies) run as ExecItems
+    # NOTE: this is after a run, so a global size without a local size was resolved
+    self._plan = []
+    for ei in self._jit_cache:
+      if isinstance(ei.prg, CompiledRunner) and not ei.fixedvars and all_int(ei.prg.p.global_size or ()) and all_int(ei.prg.p.local_size or ()):
+        lra = {k:tuple(v) for k,v in (("global_size", ei.prg.p.global_size), ("local_size", ei.prg.p.local_size)) if v}
+        self._plan.append((ei.prg._prg, [b._buf if b is not None else None for b in ei.bufs], lra, tuple(ei.prg.p.vars)))
+      else: self._plan.append(ei)
+    self._plan_inputs = [(p[1], i, idx) for (j,i),idx in self._input_replace.items() if isinstance(p:=self._plan[j], tuple)]
+    # the stats of the directly called kernels are added once per replay
+    estimates = [ei.prg.estimates for ei,p in zip(self._jit_cache, self._plan) if isinstance(p, tuple)]
+    self._plan_stats = (len(estimates), sum([e.ops for e in estimates], 0), sum([e.mem for e in estimates], 0))
+
+  def _run_plan(self, input_buffers:list[Buffer], var_vals:dict[Variable, int]):
+    for args,i,idx in self._plan_inputs: args[i] = input_buffers[idx]._buf
+    for p in cast(list, self._plan):
+      if isinstance(p, ExecItem): p.run(var_vals, jit=True)
+      else: p[0](*p[1], **p[2], vals=tuple(var_vals[v] for v in p[3]))
+    for args,i,_ in self._plan_inputs: args[i] = None
+    GlobalCounters.kernel_count += self._plan_stats[0]
+    GlobalCounters.global_ops += sym_infer(self._plan_stats[1], var_vals)
+    GlobalCounters.global_mem += sym_infer(self._plan_stats[2], var_vals)
+
 def _prepare_jit_inputs(args, kwargs):
   input_tensors: list[tuple[int|str, Tensor]] = [(name,t) for name,t in list(enumerate(args))+sorted(kwargs.items()) if t.__class__ is Tensor]
   names, tensors = [name for name,_ in input_tensors], [t for _,t in input_tensors]
@@ -222,14 +291,44 @@ def _prepare_jit_inputs(args, kwargs):
   st_vars_dtype_device = [(x[0], tuple(sorted(x[1].keys(), key=lambda v: v.expr)), x[2], x[3]) for x in st_varval_dtype_device]
   return input_buffers, var_vals, names, st_vars_dtype_device
 
+def host_callback(fxn:Callable[..., Any], *inputs:Tensor, shape:tuple[int, ...], dtype:DTypeLike|None=None, device:str|None=None) -> Tensor:
+  """
+  Calls fxn on the host with the inputs as numpy arrays and returns its result as a realized Tensor of shape and dtype.
+  Inside a TinyJit this is captured as a copy out, the call and a copy in, so the replay calls fxn again in order with the kernels.
+  """
+  inputs = tuple(t.contiguous() for t in inputs)
+  if len(inputs): Tensor.realize(*inputs)
+  assert all(isinstance(t.device, str) and all_int(t.shape) for t in inputs), "host callback inputs must be on one device with an int shape"
+  ret = Tensor.empty(*shape, dtype=to_dtype(dtype) if dtype is not None else dtypes.default_float,
+                     device=device if device is not None else inputs[0].device if len(inputs) else None)
+  ei = ExecItem(HostCallback(fxn, cast(str, ret.device), [cast(tuple[int, ...], t.shape) for t in inputs]),
+                [cast(Buffer, ret.uop.buffer).ensure_allocated(), *[cast(Buffer, t.uop.buffer) for t in inputs]])
+  if len(capturing) and CAPTURING: capturing[0].add(ei)
+  ei.run()
+  return ret
+
 class TinyJit(Generic[ReturnType]):
-  def __init__(self, fxn:Callable[..., ReturnType]|None, captured:CapturedJit|None=None, prune=False, optimize=False):
+  def __init__(self, fxn:Callable[..., ReturnType]|None, captured:CapturedJit|None=None, prune=False, optimize=False, max_captures=1,
+               buckets:tuple[int, ...]|None=None, capture_first=False, cache_key:str|None=None, prewarm=False):
     assert fxn or captured, "need either a function or a CapturedJit"
     self.fxn = fxn
     self.captured: CapturedJit|None = captured
     self.cnt: int = 2 if self.fxn is None else 0
     self.prune = prune
     self.optimize = optimize
+    # with capture_first, the first call is captured instead of being a warmup, unless it initializes state that must not be replayed
+    self.capture_first = capture_first
+    # with max_captures > 1, a CapturedJit is kept for each input signature, the least recently used ones are evicted
+    # with buckets, the first dim of the input Tensors is zero padded up to the nearest bucket, the outputs keep the padded size.
+    # every bucket gets its own capture, an input bigger than every bucket is an error
+    self.max_captures, self.buckets = max(max_captures, len(buckets)) if buckets is not None else max_captures, buckets
+    self._captures: collections.OrderedDict[tuple, tuple[CapturedJit|None, int]] = collections.OrderedDict()
+    self._signature: tuple|None = None
+    # with a cache_key, captures are saved to the disk cache and loaded in the next process if the source and the input signature match.
+    # NOTE: only the source of fxn is in the key, a change in a function it calls needs a new cache_key
+    # a capture that reads weights fxn doesn't reference itself (from its object, closure, globals or args) isn't saved, they would be stale
+    # with prewarm, the programs of a loaded capture are loaded on a background thread, see CapturedJit.prewarm
+    self.cache_key, self.prewarm = cache_key, prewarm
 
   def add_buffer(self, b:Buffer) -> Buffer:
     if found:=self._buffer_replace.get(b, None): return found
@@ -247,6 +346,32 @@ class TinyJit(Generic[ReturnType]):
     assert self.fxn is not None, "can't reset without function"
     self.cnt = 0
     self.captured = None
+    self._captures.clear()
+    self._signature = None
+
+  def _select_capture(self, signature:tuple):
+    if signature == self._signature: return
+    if self._signature is not None: self._captures[self._signature] = (self.captured, self.cnt)
+    self.captured, self.cnt = self._captures.pop(signature, (None, 0))
+    self._signature = signature
+    while len(self._captures) >= self.max_captures:
+      _, (evicted, _) = self._captures.popitem(last=False)
+      if DEBUG >= 1 and evicted is not None: print(f"JIT evicted capture with {len(evicted.jit_cache)} kernels")
+
+  @staticmethod
+  def _initialized_state(jit_cache:list[ExecItem], input_buffers:list[Buffer], ret) -> list[Buffer]:
+    depends: set[Buffer|None] = set(input_buffers)
+    update_depends(depends, jit_cache)
+    ret_buffers = flatten([rb.bufs if isinstance(rb:=t.uop.base.realized, MultiBuffer) else [rb] for t in get_parameters(ret)])
+    return [b for ei in jit_cache for b in get_out_buffers_for_ei(ei) if b not in depends and b.uop_refcount > 0 and b not in ret_buffers]
+
+  def _pad_to_bucket(self, x):
+    # pad the first dim of input Tensors up to the nearest bucket
+    if x.__class__ is not Tensor or x.ndim == 0 or not isinstance(n:=x.shape[0], int): return x
+    if (b:=next((b for b in sorted(unwrap(self.buckets)) if b >= n), None)) is None:
+      raise ValueError(f"input size {n} is bigger than every bucket {self.buckets}")
+    if b == n: return x
+    return x.pad(((0, b-n),) + (None,)*(x.ndim-1)).contiguous()
 
   def __reduce__(self):
     assert self.captured is not None, "can't pickle an uncaptured JIT"
@@ -261,14 +386,22 @@ class TinyJit(Generic[ReturnType]):
   def __get__(self, obj, objtype): return functools.partial(self.__call__, obj) # add support for instance methods
 
   def __call__(self, *args, **kwargs) -> ReturnType:
+    if self.buckets is not None: args, kwargs = tuple(self._pad_to_bucket(x) for x in args), {k:self._pad_to_bucket(v) for k,v in kwargs.items()}
     input_buffers, var_vals, names, st_vars_dtype_device = _prepare_jit_inputs(args, kwargs)
-    if not JIT or self.cnt == 0:
+    if self.max_captures > 1: self._select_capture((tuple(names), tuple(st_vars_dtype_device)))
+    if self.cache_key is not None and JIT and self.cnt == 0 and self.fxn is not None:
+      from tinygrad.engine.aot import jit_params, capture_key, load_capture
+      key = capture_key(self.cache_key, self.fxn, (tuple(names), tuple(st_vars_dtype_device)))
+      if (loaded:=load_capture(key, functools.partial(jit_params, self.fxn, args))) is not None:
+        if self.prewarm: loaded.prewarm()
+        self.captured, self.cnt = loaded, 2
+    if not JIT or (self.cnt == 0 and not self.capture_first):
       # jit ignore
       assert self.fxn is not None
       with Context(BEAM=0 if getenv("IGNORE_JIT_FIRST_BEAM") else BEAM.value):
         ret = self.fxn(*args, **kwargs)
         if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
-    elif self.cnt == 1:
+    elif self.cnt <= 1:
       # jit capture
       assert self.fxn is not None
       if capturing: raise RuntimeError(f"having TinyJit inside another TinyJit is not supported {len(capturing)=} {capturing=}")
@@ -287,6 +420,13 @@ class TinyJit(Generic[ReturnType]):
       assert len(jit_cache), "didn't JIT anything!"
       if DEBUG >= 1: print(f"JIT captured {len(jit_cache)} kernels with {len(input_buffers)} inputs")
 
+      # on a first call capture, kernels that don't depend on the inputs and write to buffers that outlive the call are initializing state,
+      # replaying them would reset it. this call was a warmup then, and the next one is captured
+      if self.cnt == 0 and len(state:=self._initialized_state(jit_cache, input_buffers, ret)):
+        if DEBUG >= 1: print(f"JIT not captured on the first call, it initialized {len(state)} buffers")
+        self.cnt += 1
+        return ret
+
       # track inputs that are views of buffers
       # TODO: eventually expected_buffers should live in ExecItem
       extra_view_inputs: list[tuple[int, int, str, int, DType]] = []
@@ -320,7 +460,13 @@ class TinyJit(Generic[ReturnType]):
 
       # set this for next run
       self.captured = CapturedJit(ret, jit_cache, input_replace, extra_view_inputs, names, st_vars_dtype_device)
+      # replanning is opt-in, the memory planner above already planned this jit cache with the same liveness.
+      # the replan allocates a new arena and rebuilds the graphs for little to no gain on a fresh capture
       if self.optimize: self.captured.replan_buffers_memory_layout()
+      if self.cache_key is not None:
+        from tinygrad.engine.aot import jit_params, capture_key, save_capture
+        save_capture(capture_key(self.cache_key, self.fxn, (tuple(names), tuple(st_vars_dtype_device))), self.captured, jit_params(self.fxn, args))
+      self.cnt = 1  # a first call capture replays from the next call too
     elif self.cnt >= 2:
       # jit exec
       assert self.captured is not None
@@ -1,10 +1,12 @@
-from typing import cast, Generator
-import time, pprint
+from typing import cast, Generator, Callable, Any
+import time, pprint, multiprocessing, multiprocessing.pool, atexit, threading
 from dataclasses import dataclass, replace, field
 from tinygrad.helpers import all_same, colored, DEBUG, GlobalCounters, ansilen, BEAM, NOOPT, all_int, CAPTURING, Metadata, TRACEMETA, TracingKey
-from tinygrad.helpers import DEVECTORIZE, time_to_str, VALIDATE_WITH_CPU, getenv
+from tinygrad.helpers import DEVECTORIZE, time_to_str, VALIDATE_WITH_CPU, getenv, PROGRAM_CACHE, CACHELEVEL, diskcache_get, diskcache_put
+from tinygrad.helpers import PARALLEL_COMPILE, COMPILE_AHEAD, LAZY_PROGRAMS, CPU_THREADS, ContextVar, Context
 from tinygrad.uop.ops import Ops, PatternMatcher, UOp, UPat, Variable, sym_infer, graph_rewrite, print_uops, track_rewrites
 from tinygrad.device import Device, Buffer
+from tinygrad.dtype import _to_np_dtype
 from tinygrad.renderer import Renderer, ProgramSpec, Estimates
 from tinygrad.engine.schedule import ScheduleItem
 from tinygrad.opt import get_optimized_ast
@@ -45,7 +47,8 @@ def get_program(ast:UOp, renderer:Renderer) -> ProgramSpec:
   src = renderer.render(uops)
 
   return ProgramSpec(uops[-1].arg.name, src, renderer.device, ast, uops,
-                     global_size=[1,1,1] if renderer.has_local else None, local_size=[1,1,1] if renderer.has_local else None)
+                     global_size=[1,1,1] if renderer.has_local or renderer.has_threads else None,
+                     local_size=[1,1,1] if renderer.has_local or renderer.has_threads else None)
 
 # **************** Runners ****************
 
@@ -59,17 +62,28 @@ class Runner:
   def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False) -> float|None:
     raise NotImplementedError("override this")
 
+_load_lock = threading.Lock()
 class CompiledRunner(Runner):
   def __init__(self, p:ProgramSpec, precompiled:bytes|None=None, prg=None):
     if DEBUG >= 4: print(p.src)
     self.p:ProgramSpec = p
     self.lib:bytes = precompiled if precompiled is not None else Device[p.device].compiler.compile_cached(p.src)
     if DEBUG >= 7: Device[p.device].compiler.disassemble(self.lib)
-    self._prg = Device[p.device].runtime(p.function_name, self.lib) if prg is None else prg
+    # with LAZY_PROGRAMS the program is loaded on the device when it's first used
+    self._loaded_prg = prg
+    if prg is None and not LAZY_PROGRAMS: self.load()
     super().__init__(p.name, p.device, p.estimates)
 
   def __reduce__(self): return self.__class__, (self.p, self.lib)
 
+  def load(self):
+    # NOTE: the lock is so a prewarm thread and a call never load the same program twice
+    with _load_lock:
+      if self._loaded_prg is None: self._loaded_prg = Device[self.p.device].runtime(self.p.function_name, self.lib)
+    return self._loaded_prg
+  @property
+  def _prg(self): return self._loaded_prg if self._loaded_prg is not None else self.load()
+
   def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False) -> float|None:
     global_size, local_size = self.p.launch_dims(var_vals)
     if global_size is not None and local_size is None and all_int(self.p.global_size): # type: ignore[arg-type]
@@ -119,20 +133,98 @@ class BufferCopy(Runner):
 class BufferXfer(BufferCopy):
   def copy(self, dest, src): dest.allocator._transfer(dest._buf, src._buf, dest.nbytes, src_dev=src.allocator.dev, dest_dev=dest.allocator.dev)
 
+class HostCallback(Runner):
+  def __init__(self, fxn:Callable[..., Any], device:str, shapes:list[tuple[int, ...]]):
+    super().__init__(colored(f"host {getattr(fxn, '__name__', 'callback')}", "yellow"), device)
+    self.fxn, self.shapes = fxn, shapes
+  def __call__(self, rawbufs:list[Buffer], var_vals:dict[Variable, int], wait=False):
+    import numpy as np
+    # copy out the inputs, call fxn and copy its result into the output
+    out, *ins = rawbufs
+    st = time.perf_counter()
+    ret = np.asarray(self.fxn(*[x.numpy().reshape(shape) for x,shape in zip(ins, self.shapes)]), dtype=_to_np_dtype(out.dtype))
+    assert ret.size == out.size, f"host callback returned {ret.size} elements, expected {out.size}"
+    out.copyin(np.ascontiguousarray(ret).reshape(-1).data)
+    if wait:
+      Device[out.device].synchronize()
+      return time.perf_counter() - st
+
 # **************** method cache ****************
 
+# TODO: this should be all context relevant to rendering
+def method_context() -> tuple[int, ...]: return (BEAM.value, NOOPT.value, DEVECTORIZE.value, CPU_THREADS.value)
+
+# diagnostics, caching and runtime settings that don't change the program. they differ between the compile workers and this process
+PROGRAM_CACHE_IGNORE = {"DEBUG", "PROFILE", "VIZ", "TRACEMETA", "CAPTURING", "ALLOW_DEVICE_USAGE", "VALIDATE_WITH_CPU", "CACHELEVEL", "PROGRAM_CACHE",
+                        "DISABLE_COMPILER_CACHE", "IGNORE_BEAM_CACHE", "CACHESIZE", "CACHETTL", "CACHE_BATCH", "CACHE_ASYNC", "CACHE_MEM_SIZE",
+                        "PARALLEL_COMPILE", "COMPILE_AHEAD", "LAZY_PROGRAMS", "SCHEDULE_CACHE", "JIT", "JIT_BATCH_SIZE", "PICKLE_BUFFERS", "LRU"}
+
+def get_program_cached(ast:UOp, renderer:Renderer) -> ProgramSpec:
+  # NOTE: the ProgramSpec is keyed on the AST, so this cache must be invalidated (bump VERSION) when lowering changes
+  if not PROGRAM_CACHE or CACHELEVEL < 1: return get_program(ast, renderer)
+  # the other ContextVars are in the key, like kernelize_cache, since which ones change codegen isn't tracked
+  key = {"ast": ast.key, "device": renderer.device, "suffix": renderer.suffix,
+         "renderer": f"{type(renderer).__name__}:{getattr(renderer, 'arch', '')}",
+         "context": ",".join(f"{k}={v.value}" for k,v in sorted(ContextVar._cache.items()) if k not in PROGRAM_CACHE_IGNORE)}
+  if (ret:=diskcache_get("get_program", key)) is not None: return replace(ret, ast=ast)
+  return diskcache_put("get_program", key, get_program(ast, renderer))
+
+# **************** parallel compile ****************
+
+compile_pool = None
+compile_futures: dict[tuple[str, bytes, tuple[int, ...], bool], multiprocessing.pool.AsyncResult] = {}
+def _compile_local(ast:UOp, renderer:Renderer, compiler) -> tuple[ProgramSpec, bytes]:
+  p = get_program_cached(ast, renderer)
+  return p, compiler.compile_cached(p.src)
+def _compile_program(ast:UOp, renderer:Renderer, compiler, ctx:dict[str, int]) -> tuple[ProgramSpec, bytes]:
+  # only the ContextVars the worker has imported, others are from user code
+  with Context(**{k:v for k,v in ctx.items() if k in ContextVar._cache}): return _compile_local(ast, renderer, compiler)
+
+def _compile_todo(schedule:list[ScheduleItem], context:tuple[int, ...]) -> dict[tuple[str, bytes, tuple[int, ...], bool], tuple[UOp, str]]:
+  todo: dict[tuple[str, bytes, tuple[int, ...], bool], tuple[UOp, str]] = {}
+  for si in schedule:
+    if si.ast.op is not Ops.SINK or (bkey:=(si.bufs[0].device.split(":")[0], si.ast.key, context, True)) in method_cache: continue
+    if bkey not in compile_futures: todo[bkey] = (si.ast, si.bufs[0].device)
+  return todo
+
+def _compile_submit(todo:dict[tuple[str, bytes, tuple[int, ...], bool], tuple[UOp, str]]) -> list:
+  # NOTE: UOps and the rewrite state aren't thread safe, so the kernels are lowered and compiled in worker processes
+  global compile_pool
+  if compile_pool is None:
+    from tinygrad.opt.search import _init_worker
+    compile_pool = multiprocessing.get_context("spawn").Pool(max(PARALLEL_COMPILE.value, 1), _init_worker, (), getenv("BEAM_MAX_TASKS_PER_CHILD", 16))
+    atexit.register(compile_pool.close)
+  ctx = {k:v.value for k,v in ContextVar._cache.items() if k not in {"ALLOW_DEVICE_USAGE", "VIZ"}}
+  for bkey,(ast,device) in todo.items():
+    compile_futures[bkey] = compile_pool.apply_async(_compile_program, (ast, Device[device].renderer, Device[device].compiler, ctx))
+  return list(todo)
+
+def compile_ahead(schedule:list[ScheduleItem]) -> list:
+  """Lowers and compiles the kernels of the schedule that aren't in the method cache on a pool of PARALLEL_COMPILE workers."""
+  todo = _compile_todo(schedule, method_context())
+  # NOTE: BEAM search needs the device, so it stays in this process
+  if len(todo) < 2 or BEAM >= 1: return []
+  if DEBUG >= 2: print(f"compiling {len(todo)} kernels on {PARALLEL_COMPILE.value} workers")
+  return _compile_submit(todo)
+
+def pipeline_ahead(schedule:list[ScheduleItem]) -> list:
+  """Compiles the kernels of the next COMPILE_AHEAD schedule items on the compile pool while this one runs."""
+  # NOTE: BEAM search needs the device, and programs are loaded on the device in get_runner, so only rendering and compiling is in the pool
+  if BEAM >= 1 or not (todo:=_compile_todo(schedule[:COMPILE_AHEAD.value], method_context())): return []
+  return _compile_submit(todo)
+
 method_cache: dict[tuple[str, bytes, tuple[int, ...], bool], CompiledRunner] = {}
 def get_runner(device:str, ast:UOp) -> CompiledRunner:
-  # TODO: this should be all context relevant to rendering
-  context = (BEAM.value, NOOPT.value, DEVECTORIZE.value)
+  context = method_context()
   ckey = (device, ast.key, context, False)
   if cret:=method_cache.get(ckey): return cret
   bkey = (device.split(":")[0], ast.key, context, True)
   if bret:=method_cache.get(bkey):
     method_cache[ckey] = ret = CompiledRunner(replace(bret.p, device=device), bret.lib)
   else:
-    prg: ProgramSpec = get_program(ast, Device[device].renderer)
-    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, device=device))
+    # wait for the kernel if it's being compiled ahead
+    prg, lib = compile_futures.pop(bkey).get() if bkey in compile_futures else (get_program_cached(ast, Device[device].renderer), None)
+    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, device=device), lib)
   return ret
 
 # **************** lowering functions ****************
@@ -174,15 +266,21 @@ def lower_schedule_item(si:ScheduleItem) -> ExecItem:
   return ExecItem(*cast(tuple[Runner,list], si_lowerer.rewrite(si.ast, si.bufs)), si.metadata, si.fixedvars)
 
 def lower_schedule(schedule:list[ScheduleItem]) -> Generator[tuple[ScheduleItem, ExecItem], None, None]:
-  while len(schedule):
-    si = schedule.pop(0)
-    try: yield (si, lower_schedule_item(si))
-    except Exception as e:
-      if DEBUG >= 2:
-        print(f"error lowering {si.ast.op}")
-        print("tensor operations:")
-        pprint.pprint(si.metadata, indent=2)
-      raise e
+  submitted = compile_ahead(schedule) if PARALLEL_COMPILE else []
+  try:
+    while len(schedule):
+      if COMPILE_AHEAD: submitted += pipeline_ahead(schedule)
+      si = schedule.pop(0)
+      try: yield (si, lower_schedule_item(si))
+      except Exception as e:
+        if DEBUG >= 2:
+          print(f"error lowering {si.ast.op}")
+          print("tensor operations:")
+          pprint.pprint(si.metadata, indent=2)
+        raise e
+  finally:
+    # kernels compiled ahead that weren't used, e.g. after an error, aren't waited on
+    for bkey in submitted: compile_futures.pop(bkey, None)
 
 # **************** main run function ****************
 
@@ -1,9 +1,10 @@
-from typing import cast
+import heapq, itertools
+from typing import cast, Callable
 from dataclasses import dataclass, field
 from collections import deque, defaultdict
 from tinygrad.uop.ops import UOp, Variable, Ops, UPat, PatternMatcher, graph_rewrite, buffers
 from tinygrad.device import Device, Buffer, MultiBuffer
-from tinygrad.helpers import Metadata, unwrap, all_same, merge_dicts
+from tinygrad.helpers import Metadata, unwrap, all_same, merge_dicts, dedup, DEBUG, SCHEDULE_ORDER, MEMORY_BUDGET
 
 # **** ScheduleItem return type
 
@@ -34,13 +35,83 @@ pm_unbind = PatternMatcher([
   (UPat(Ops.BIND, name="x"), unbind_bind),
 ])
 
+# **** schedule order
+
+# an order gets the KERNEL graph (children and in_degree of each KERNEL in toposort order) and the sink, and returns the KERNELs in a valid order
+ScheduleOrder = Callable[[dict[UOp, list[UOp]], dict[UOp, int], UOp], list[UOp]]
+
+def bfs_order(children:dict[UOp, list[UOp]], in_degree:dict[UOp, int], sink:UOp) -> list[UOp]:
+  # BFS, copies between device groups are put together
+  def _heuristic(k: UOp):
+    if k.arg.ast.op is Ops.COPY and not all_same([Device[cast(Buffer, s.buf_uop.buffer).device].group_id for s in k.src]): return 1000
+    return 0
+
+  last_heuristic: int = 0
+  queues: defaultdict[int, deque[UOp]] = defaultdict(deque)
+  last_queue: deque[UOp] = deque()
+  for k,v in in_degree.items():
+    if v == 0: queues[_heuristic(k)].append(k)
+
+  order: list[UOp] = []
+  while last_queue or any(queues.values()):
+    if not last_queue: last_heuristic, last_queue = min((it for it in queues.items() if it[1]), key=lambda x: abs(x[0]-last_heuristic))
+    order.append(k:=last_queue.popleft())
+    for x in children[k]:
+      in_degree[x] -= 1
+      if in_degree[x] == 0: queues[_heuristic(x)].append(x)
+  return order
+
+def buf_nbytes(b:UOp) -> int: return b.size*b.dtype.itemsize
+
+def memory_order(children:dict[UOp, list[UOp]], in_degree:dict[UOp, int], sink:UOp) -> list[UOp]:
+  # greedily runs the ready KERNEL that grows the live memory the least: the buffers it writes minus the ones it's the last reader of
+  outs: defaultdict[UOp, list[UOp]] = defaultdict(list)
+  for u in sink.toposort():
+    if u.op is Ops.ASSIGN: outs[u.src[1]].append(u.buf_uop)
+  ins = {k:dedup(s.buf_uop for s in k.src if s.op is Ops.ASSIGN) for k in in_degree}
+  readers: defaultdict[UOp, int] = defaultdict(int)
+  for b in (b for k in in_degree for b in ins[k]): readers[b] += 1
+  # the buffers of the sink are still live after the schedule
+  keep = {s.base.buf_uop for s in sink.src if s.base.op in {Ops.BUFFER, Ops.ASSIGN}}
+  def grows(k:UOp) -> int: return sum(buf_nbytes(b) for b in outs[k]) - sum(buf_nbytes(b) for b in ins[k] if readers[b] == 1 and b not in keep)
+
+  ready = [k for k,v in in_degree.items() if v == 0]
+  order: list[UOp] = []
+  while ready:
+    order.append(k:=ready.pop(min(range(len(ready)), key=lambda i: grows(ready[i]))))
+    for b in ins[k]: readers[b] -= 1
+    for x in children[k]:
+      in_degree[x] -= 1
+      if in_degree[x] == 0: ready.append(x)
+  return order
+
+def critical_path_order(children:dict[UOp, list[UOp]], in_degree:dict[UOp, int], sink:UOp) -> list[UOp]:
+  # the KERNEL with the longest chain of KERNELs after it runs first, so the work off the critical path overlaps with it. copies start early
+  depth: dict[UOp, int] = {}
+  for k in reversed(in_degree): depth[k] = 1+max([depth[x] for x in children[k]], default=0)
+  idx = {k:i for i,k in enumerate(in_degree)}
+  def prio(k:UOp) -> tuple[int, bool, int]: return (-depth[k], k.arg.ast.op is not Ops.COPY, idx[k])
+  ready = [prio(k) for k,v in in_degree.items() if v == 0]
+  heapq.heapify(ready)
+  kernels = list(in_degree)
+  order: list[UOp] = []
+  while ready:
+    order.append(k:=kernels[heapq.heappop(ready)[2]])
+    for x in children[k]:
+      in_degree[x] -= 1
+      if in_degree[x] == 0: heapq.heappush(ready, prio(x))
+  return order
+
+schedule_orders: list[ScheduleOrder] = [bfs_order, memory_order, critical_path_order]
+
 # **** schedule linearizer
 
-def create_schedule_with_vars(sched_sink:UOp) -> tuple[list[ScheduleItem], dict[Variable, int]]:
+def linearize_kernels(sched_sink:UOp, order:ScheduleOrder|None=None) -> list[UOp]:
   # construct the KERNEL children graph based on assigns
   children: defaultdict[UOp, list[UOp]] = defaultdict(list)
   in_degree: dict[UOp, int] = {}
-  for u in sched_sink.toposort():
+  readers: defaultdict[UOp, list[UOp]] = defaultdict(list)
+  for u in (topo:=sched_sink.toposort()):
     if u.op is not Ops.ASSIGN: continue  # anything that's not an ASSIGN doesn't write a kernel, so we can skip
     k = u.src[1]
     in_degree.setdefault(k, 0)
@@ -56,27 +127,27 @@ def create_schedule_with_vars(sched_sink:UOp) -> tuple[list[ScheduleItem], dict[
             children[ss.src[1]].append(k)
             in_degree[k] += 1
       elif s.op is Ops.BUFFER:
-        pass  # a BUFFER is already realized, nothing to do here
+        readers[s].append(k)  # a BUFFER is already realized, it's only read before it's assigned
       else:
         raise RuntimeError(f"input to kernel must be ASSIGN or BUFFER, not {s.op}")
+  # a kernel assigning to a realized BUFFER runs after the other kernels that read it
+  for u in topo:
+    if u.op is not Ops.ASSIGN or u.src[0].op is not Ops.BUFFER: continue
+    for r in readers[u.src[0]]:
+      if r is u.src[1]: continue
+      children[r].append(u.src[1])
+      in_degree[u.src[1]] += 1
 
-  # linearize KERNEL UOps into ScheduleItems in BFS order
-
-  def _heuristic(k: UOp):
-    if k.arg.ast.op is Ops.COPY and not all_same([Device[cast(Buffer, s.buf_uop.buffer).device].group_id for s in k.src]): return 1000
-    return 0
-
-  last_heuristic: int = 0
-  queues: defaultdict[int, deque[UOp]] = defaultdict(deque)
-  last_queue: deque[UOp] = deque()
-  for k,v in in_degree.items():
-    if v == 0: queues[_heuristic(k)].append(k)
+  # linearize KERNEL UOps in the order from SCHEDULE_ORDER, 0 is BFS, 1 is the least live memory and 2 is the critical path
+  kernels = (order or schedule_orders[SCHEDULE_ORDER.value])(children, in_degree, sched_sink)
+  # a cycle in the KERNEL graph leaves its kernels out of the order
+  assert len(kernels) == len(in_degree), f"cycle in the KERNEL graph, only {len(kernels)} of {len(in_degree)} kernels were ordered"
+  return kernels
 
+def create_schedule_with_vars(sched_sink:UOp, order:ScheduleOrder|None=None) -> tuple[list[ScheduleItem], dict[Variable, int]]:
   schedule: list[ScheduleItem] = []
   var_vals: dict[Variable, int] = {}
-  while last_queue or any(queues.values()):
-    if not last_queue: last_heuristic, last_queue = min((it for it in queues.items() if it[1]), key=lambda x: abs(x[0]-last_heuristic))
-    k = last_queue.popleft()
+  for k in linearize_kernels(sched_sink, order):
     # unbind var_vals from the kernel
     local_var_vals: list[dict[Variable, int]] = []
     ast = graph_rewrite(k.arg.ast, pm_unbind, ctx=local_var_vals, name="unbind vars")
@@ -95,8 +166,46 @@ def create_schedule_with_vars(sched_sink:UOp) -> tuple[list[ScheduleItem], dict[
     else:
       # ONE -> ONE
       schedule.append(ScheduleItem(ast, cast(tuple[Buffer, ...], ubufs), k.arg.metadata))
-    for x in children[k]:
-      in_degree[x] -= 1
-      if in_degree[x] == 0: queues[_heuristic(x)].append(x)
 
   return schedule, var_vals
+
+# **** memory budget
+
+def rematerialize_buffers(sched_sink:UOp, intermediates:list[UOp], candidates:list[UOp]) -> list[UOp]:
+  """
+  Picks the candidate BUFFERs that are recomputed in the kernels that read them, until the peak memory of the intermediates fits in MEMORY_BUDGET.
+  The biggest go first, one is only picked if the memory goes down. It's updated from the live ranges over one order of the KERNEL graph.
+  """
+  kernels = linearize_kernels(sched_sink)
+  step = {k:i for i,k in enumerate(kernels)}
+  ins = {u.buf_uop:{s.buf_uop for s in u.src[1].src if s.op is Ops.ASSIGN} for u in sched_sink.toposort() if u.op is Ops.ASSIGN}
+  # the live range of an intermediate is from the kernel that writes it to the last kernel that reads it
+  writer = {u.buf_uop:step[u.src[1]] for u in sched_sink.toposort() if u.op is Ops.ASSIGN}
+  live_range = {b:[writer[b], writer[b]] for b in intermediates}
+  for k in kernels:
+    for b in (s.buf_uop for s in k.src if s.op is Ops.ASSIGN):
+      if b in live_range: live_range[b][1] = max(live_range[b][1], step[k])
+  live = [0]*(len(kernels)+1)
+  for b,(st,en) in live_range.items():
+    live[st] += buf_nbytes(b)
+    live[en+1] -= buf_nbytes(b)
+  live = list(itertools.accumulate(live))[:-1]
+  start = peak = max(live, default=0)
+  picked: list[UOp] = []
+  for x in sorted([x for x in candidates if x in live_range], key=lambda x: -buf_nbytes(x)):
+    if peak <= MEMORY_BUDGET.value: break
+    # x isn't live, the buffers its kernel reads are live up to the last reader of x instead
+    new_live, (st,en) = live[:], live_range[x]
+    for i in range(st, en+1): new_live[i] -= buf_nbytes(x)
+    extend = [b for b in ins[x] if b in live_range and live_range[b][1] < en]
+    for b in extend:
+      for i in range(live_range[b][1]+1, en+1): new_live[i] += buf_nbytes(b)
+    # with a few steps at the peak, one can go down without the peak going down
+    if (max(new_live, default=0), sum(new_live)) >= (peak, sum(live)): continue
+    live, peak = new_live, max(new_live, default=0)
+    for b in extend: live_range[b][1] = en
+    for b in ins:
+      if x in ins[b]: ins[b] = (ins[b] - {x}) | ins[x]
+    picked.append(x)
+  if DEBUG >= 1: print(f"rematerialized {len(picked)} buffers, peak memory {start/1e6:.2f} MB -> {peak/1e6:.2f} MB")
+  return picked
@@ -1,6 +1,6 @@
 from __future__ import annotations
 import os, functools, platform, time, re, contextlib, operator, hashlib, pickle, sqlite3, tempfile, pathlib, string, ctypes, sys, gzip, getpass
-import urllib.request, subprocess, shutil, math, types, copyreg, inspect, importlib, decimal
+import urllib.request, subprocess, shutil, math, types, copyreg, inspect, importlib, decimal, threading, atexit
 from dataclasses import dataclass
 from typing import ClassVar, Iterable, Any, TypeVar, Callable, Sequence, TypeGuard, Iterator, Generic, Generator
 
@@ -128,7 +128,12 @@ FUSE_ARANGE, FUSE_CONV_BW = ContextVar("FUSE_ARANGE", 0), ContextVar("FUSE_CONV_
 SPLIT_REDUCEOP, NO_MEMORY_PLANNER, RING = ContextVar("SPLIT_REDUCEOP", 1), ContextVar("NO_MEMORY_PLANNER", 0), ContextVar("RING", 1)
 PICKLE_BUFFERS, PROFILE, LRU = ContextVar("PICKLE_BUFFERS", 1), ContextVar("PROFILE", getenv("VIZ")), ContextVar("LRU", 1)
 CACHELEVEL, IGNORE_BEAM_CACHE, DEVECTORIZE = ContextVar("CACHELEVEL", 2), ContextVar("IGNORE_BEAM_CACHE", 0), ContextVar("DEVECTORIZE", 1)
-DISABLE_COMPILER_CACHE = ContextVar("DISABLE_COMPILER_CACHE", 0)
+DISABLE_COMPILER_CACHE, PROGRAM_CACHE = ContextVar("DISABLE_COMPILER_CACHE", 0), ContextVar("PROGRAM_CACHE", 0)
+PARALLEL_COMPILE, COMPILE_AHEAD, LAZY_PROGRAMS = ContextVar("PARALLEL_COMPILE", 0), ContextVar("COMPILE_AHEAD", 0), ContextVar("LAZY_PROGRAMS", 0)
+CPU_THREADS = ContextVar("CPU_THREADS", 1)
+SCHEDULE_CACHE, SCHEDULE_ORDER, MEMORY_BUDGET = ContextVar("SCHEDULE_CACHE", 0), ContextVar("SCHEDULE_ORDER", 0), ContextVar("MEMORY_BUDGET", 0)
+CACHESIZE, CACHETTL = ContextVar("CACHESIZE", 0), ContextVar("CACHETTL", 0)
+CACHE_BATCH, CACHE_ASYNC, CACHE_MEM_SIZE = ContextVar("CACHE_BATCH", 0), ContextVar("CACHE_ASYNC", 0), ContextVar("CACHE_MEM_SIZE", 1<<26)
 DONT_REALIZE_EXPAND, DONT_GROUP_REDUCES = ContextVar("DONT_REALIZE_EXPAND", 0), ContextVar("DONT_GROUP_REDUCES", 0)
 QUANTIZE, VALIDATE_WITH_CPU = ContextVar("QUANTIZE", 0), ContextVar("VALIDATE_WITH_CPU", 0)
 CORRECT_DIVMOD_FOLDING, FUSE_OPTIM = ContextVar("CORRECT_DIVMOD_FOLDING", 0), ContextVar("FUSE_OPTIM", 0)
@@ -206,56 +211,279 @@ def cpu_profile(name:str|TracingKey, device="CPU", is_copy=False, display=True)
     res.en = decimal.Decimal(time.perf_counter_ns()) / 1000
     if PROFILE and display: cpu_events.append(res)
 
+# *** scheduling time by pass ***
+
+class ScheduleTiming(contextlib.ContextDecorator):
+  """
+  Collects the calls, time and UOps processed of each scheduling pass while active, `as_dict` exports them by pass name.
+  Nested passes like the graph_rewrites of kernelize are named by their path, and their time and UOps count in the outer pass too.
+  """
+  active: ClassVar[list[ScheduleTiming]] = []
+  def __enter__(self):
+    self.passes: dict[str, list] = {}  # name -> [calls, ms, uops]
+    ScheduleTiming.active.append(self)
+    return self
+  def __exit__(self, *exc): ScheduleTiming.active.remove(self)
+  def as_dict(self) -> dict[str, dict[str, int|float]]: return {k:{"calls":c, "ms":ms, "uops":u} for k,(c,ms,u) in self.passes.items()}
+
+# the open scheduling passes, innermost last. graph_rewrite adds the UOps it processed to the innermost one
+schedule_passes: list[tuple[str, list[int]]] = []
+@contextlib.contextmanager
+def schedule_pass(name:str) -> Generator[list[int], None, None]:
+  schedule_passes.append((path:=f"{schedule_passes[-1][0]}/{name}" if schedule_passes else name, uops:=[0]))
+  try:
+    with cpu_profile(path, "TINY") as e: yield uops
+  finally:
+    schedule_passes.pop()
+    if schedule_passes: schedule_passes[-1][1][0] += uops[0]
+    for t in ScheduleTiming.active:
+      p = t.passes.setdefault(path, [0, 0.0, 0])
+      p[0], p[1], p[2] = p[0]+1, p[1]+float(unwrap(e.en)-e.st)/1e3, p[2]+uops[0]
+
 # *** universal database cache ***
 
 cache_dir: str = os.path.join(getenv("XDG_CACHE_HOME", os.path.expanduser("~/Library/Caches" if OSX else "~/.cache")), "tinygrad")
 CACHEDB: str = getenv("CACHEDB", os.path.abspath(os.path.join(cache_dir, "cache.db")))
 
-VERSION = 21
-_db_connection = None
+VERSION = 22
+# NOTE: sqlite connections can't be shared between threads, so the background writer gets its own
+_db_local = threading.local()
 def db_connection():
-  global _db_connection
-  if _db_connection is None:
+  if (conn:=getattr(_db_local, "conn", None)) is None:
     os.makedirs(CACHEDB.rsplit(os.sep, 1)[0], exist_ok=True)
-    _db_connection = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    _db_local.conn = conn = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    # NOTE: auto_vacuum only applies to a freshly created database, this is needed for incremental_vacuum after eviction
+    # an existing database is switched over by the VACUUM in diskcache_evict
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA auto_vacuum=INCREMENTAL").fetchone()
     # another connection has set it already or is in the process of setting it
     # that connection will lock the database
-    with contextlib.suppress(sqlite3.OperationalError): _db_connection.execute("PRAGMA journal_mode=WAL").fetchone()
-    if DEBUG >= 8: _db_connection.set_trace_callback(print)
-  return _db_connection
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    if DEBUG >= 8: conn.set_trace_callback(print)
+  return conn
 
 def diskcache_clear():
+  with _db_lock: _db_pending.clear()
+  _mem_clear()
   cur = db_connection().cursor()
   drop_tables = cur.execute("SELECT 'DROP TABLE IF EXISTS ' || quote(name) || ';' FROM sqlite_master WHERE type = 'table';").fetchall()
   cur.executescript("\n".join([s[0] for s in drop_tables] + ["VACUUM;"]))
 
+# *** eviction, the size limits are in bytes of pickled values. CACHESIZE_<TABLE> limits a single table, CACHESIZE limits the whole cache
+
+ATIME_RESOLUTION, EVICT_INTERVAL = getenv("CACHE_ATIME_RESOLUTION", 60), getenv("CACHE_EVICT_INTERVAL", 64)
+def _table_limit(table:str) -> int: return getenv("CACHESIZE_"+re.sub(r"\W", "_", table).upper(), 0)
+@functools.cache
+def _has_table_limits() -> bool: return any(k.startswith("CACHESIZE_") for k in os.environ)
+def _evicting() -> bool: return bool(CACHESIZE or CACHETTL or _has_table_limits())
+
+def diskcache_evict(max_bytes:int|None=None, ttl:int|None=None) -> int:
+  """Drops the tables of older VERSIONs and deletes rows not accessed within `ttl` seconds,
+  then the least recently used rows until every table and the whole cache fit their limits."""
+  max_bytes, ttl = CACHESIZE.value if max_bytes is None else max_bytes, CACHETTL.value if ttl is None else ttl
+  diskcache_flush()
+  conn, now, evicted = db_connection(), int(time.time()), 0
+  cur = conn.cursor()
+  names = [x[0] for x in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+  tables, stale = [], []
+  for name in names:
+    if name.endswith(f"_{VERSION}"): tables.append(name)
+    elif (m:=re.fullmatch(r"(.*)_(\d+)", name)) and (v:=int(m.group(2))) < VERSION:
+      # a table of the last VERSION is kept until diskcache_migrate had its chance, that's when the current table exists
+      if v < VERSION-1 or f"{m.group(1)}_{VERSION}" in names: stale.append(name)
+  # tables of older VERSIONs are only read by diskcache_migrate, they aren't counted in the limits so they're dropped
+  for name in stale:
+    evicted += cur.execute(f"SELECT count(*) FROM '{name}'").fetchone()[0]
+    cur.execute(f"DROP TABLE '{name}'")
+  kept: list[tuple[int, int, str, int]] = []
+  for name in tables:
+    if ttl: evicted += cur.execute(f"DELETE FROM '{name}' WHERE atime < ?", (now-ttl,)).rowcount
+    rows = cur.execute(f"SELECT atime, rowid, length(val) FROM '{name}' ORDER BY atime DESC").fetchall()
+    total, limit, drop = 0, _table_limit(name[:-len(f"_{VERSION}")]), []
+    for atime, rowid, sz in rows:
+      if limit and (total:=total+sz) > limit: drop.append((rowid,))
+      else: kept.append((atime, sz, name, rowid))
+    evicted += cur.executemany(f"DELETE FROM '{name}' WHERE rowid = ?", drop).rowcount
+  if max_bytes:
+    drop_global: dict[str, list[tuple[int]]] = {}
+    total = 0
+    for _, sz, name, rowid in sorted(kept, reverse=True):
+      if (total:=total+sz) > max_bytes: drop_global.setdefault(name, []).append((rowid,))
+    for name, drop in drop_global.items(): evicted += cur.executemany(f"DELETE FROM '{name}' WHERE rowid = ?", drop).rowcount
+  conn.commit()
+  if evicted:
+    if DEBUG >= 2: print(f"diskcache: evicted {evicted} rows")
+    # a cache.db created before auto_vacuum was set needs one full VACUUM to switch to incremental (2)
+    if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2: cur.executescript("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+    cur.execute("PRAGMA incremental_vacuum").fetchall()
+  cur.close()
+  return evicted
+
+# *** process local read-through cache of pickled values, bounded to CACHE_MEM_SIZE bytes in LRU order
+# NOTE: values are unpickled on every hit, so a caller mutating what it got doesn't change the cached value
+
+diskcache_stats: dict[str, int] = {"mem_hits": 0, "disk_hits": 0, "misses": 0}
+_db_mem: dict[tuple[str, bytes], bytes] = {}
+_db_mem_size = 0
+def _mem_key(table:str, key:dict) -> tuple[str, bytes]: return (table, hashlib.sha256(repr(tuple(key.items())).encode()).digest())
+def _mem_pop(mkey:tuple[str, bytes]):
+  global _db_mem_size
+  if (ent:=_db_mem.pop(mkey, None)) is not None: _db_mem_size -= len(ent)
+def _mem_clear():
+  global _db_mem_size
+  _db_mem.clear()
+  _db_mem_size = 0
+def _mem_put(mkey:tuple[str, bytes], val:bytes):
+  global _db_mem_size
+  if len(val) > CACHE_MEM_SIZE.value: return
+  _mem_pop(mkey)
+  _db_mem[mkey], _db_mem_size = val, _db_mem_size + len(val)
+  while _db_mem_size > CACHE_MEM_SIZE.value: _mem_pop(next(iter(_db_mem)))
+
+# *** read-only bundles, exported with diskcache_export and mounted behind the local cache with CACHEBUNDLES or diskcache_mount
+
+diskcache_bundles: list[str] = [x for x in getenv("CACHEBUNDLES", "").split(os.pathsep) if x]
+def diskcache_mount(fn:str): diskcache_bundles.append(os.path.abspath(fn))
+def _bundle_connections() -> list[sqlite3.Connection]:
+  conns: dict[str, sqlite3.Connection] = _db_local.__dict__.setdefault("bundles", {})
+  for fn in diskcache_bundles:
+    if fn not in conns: conns[fn] = sqlite3.connect(f"file:{fn}?mode=ro", uri=True, timeout=60)
+  return [conns[fn] for fn in diskcache_bundles]
+
+_db_recorded: set[tuple[str, tuple]]|None = None
+@contextlib.contextmanager
+def diskcache_record() -> Generator[set[tuple[str, tuple]], None, None]:
+  """Records the (table, key) of every row read or written inside the context, pass them to diskcache_export to bundle them."""
+  global _db_recorded
+  old, _db_recorded = _db_recorded, set()
+  try: yield _db_recorded
+  finally:
+    if old is not None: old.update(_db_recorded)
+    _db_recorded = old
+
+def diskcache_export(fn:str, rows:Iterable[tuple[str, tuple|None]]|None=None) -> int:
+  """Writes `rows` (or the whole cache) from the local cache and mounted bundles into a standalone bundle at `fn`. Returns the rows written."""
+  diskcache_flush()
+  srcs: list[tuple[sqlite3.Connection, dict[str, str]]] = []
+  for conn in [db_connection(), *_bundle_connections()]:
+    tables = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall()
+    srcs.append((conn, {t[:-len(f"_{VERSION}")]:sql for t,sql in tables if t.endswith(f"_{VERSION}")}))
+  if rows is None: rows = [(t, None) for _,schemas in srcs for t in schemas]
+  out, written = sqlite3.connect(fn), 0
+  for table, key in dedup(rows):
+    for conn, schemas in srcs:
+      if table not in schemas: continue
+      with contextlib.suppress(sqlite3.OperationalError): out.execute(schemas[table])  # fails if the table was already created
+      where = "" if key is None else f" WHERE {' AND '.join(f'{k}=?' for k,_ in key)}"
+      sel = conn.execute(f"SELECT * FROM '{table}_{VERSION}'{where}", tuple(v for _,v in key or ())).fetchall()
+      for r in sel: out.execute(f"REPLACE INTO '{table}_{VERSION}' VALUES ({', '.join(['?']*len(r))})", r)
+      written += len(sel)
+      if sel and key is not None: break
+  out.commit()
+  out.close()
+  return written
+
 def diskcache_get(table:str, key:dict|str|int) -> Any:
   if CACHELEVEL < 1: return None
   if isinstance(key, (str,int)): key = {"key": key}
-  cur = db_connection().cursor()
-  try:
-    res = cur.execute(f"SELECT val FROM '{table}_{VERSION}' WHERE {' AND '.join([f'{x}=?' for x in key.keys()])}", tuple(key.values()))
-  except sqlite3.OperationalError:
-    return None  # table doesn't exist
-  if (val:=res.fetchone()) is not None: return pickle.loads(val[0])
+  if _db_recorded is not None: _db_recorded.add((table, tuple(key.items())))
+  # read your own writes that are still waiting to be flushed
+  if _db_pending and (row:=_db_pending.get((table, tuple(key.items())))) is not None: return pickle.loads(row[2])
+  if (ent:=_db_mem.pop(mkey:=_mem_key(table, key), None)) is not None:
+    _db_mem[mkey] = ent  # move to the back of the LRU order
+    diskcache_stats["mem_hits"] += 1
+    return pickle.loads(ent)
+  where = ' AND '.join([f'{x}=?' for x in key.keys()])
+  for conn in [local:=db_connection(), *(_bundle_connections() if diskcache_bundles else [])]:
+    try: val = conn.execute(f"SELECT val, atime FROM '{table}_{VERSION}' WHERE {where}", tuple(key.values())).fetchone()
+    except sqlite3.OperationalError: continue  # table doesn't exist
+    if val is None: continue
+    # access times are only tracked when eviction is enabled, and coarsely, so that cache hits rarely become writes
+    if conn is local and _evicting() and (now:=int(time.time())) - val[1] >= ATIME_RESOLUTION:
+      conn.execute(f"UPDATE '{table}_{VERSION}' SET atime=? WHERE {where}", (now,) + tuple(key.values()))
+      conn.commit()
+    diskcache_stats["disk_hits"] += 1
+    _mem_put(mkey, val[0])
+    return pickle.loads(val[0])
+  diskcache_stats["misses"] += 1
   return None
 
-_db_tables = set()
-def diskcache_put(table:str, key:dict|str|int, val:Any, prepickled=False):
-  if CACHELEVEL < 1: return val
-  if isinstance(key, (str,int)): key = {"key": key}
+# *** writes, with CACHE_BATCH>1 puts are buffered and flushed in one transaction. CACHE_ASYNC flushes from a background thread
+
+FLUSH_INTERVAL = getenv("CACHE_FLUSH_INTERVAL", 1.0)
+_db_tables: set[str] = set()
+_db_pending: dict[tuple, tuple[str, dict, bytes]] = {}
+_db_lock, _db_flush_lock, _db_wakeup = threading.Lock(), threading.Lock(), threading.Event()
+_db_writer: threading.Thread|None = None
+_db_puts, _db_last_flush = 0, time.perf_counter()
+
+def _db_write(rows:list[tuple[str, dict, bytes]]):
   conn = db_connection()
   cur = conn.cursor()
-  if table not in _db_tables:
-    TYPES = {str: "text", bool: "integer", int: "integer", float: "numeric", bytes: "blob"}
-    ltypes = ', '.join(f"{k} {TYPES[type(key[k])]}" for k in key.keys())
-    cur.execute(f"CREATE TABLE IF NOT EXISTS '{table}_{VERSION}' ({ltypes}, val blob, PRIMARY KEY ({', '.join(key.keys())}))")
-    _db_tables.add(table)
-  cur.execute(f"REPLACE INTO '{table}_{VERSION}' ({', '.join(key.keys())}, val) VALUES ({', '.join(['?']*len(key))}, ?)", tuple(key.values()) + (val if prepickled else pickle.dumps(val), ))  # noqa: E501
+  for table, key, val in rows:
+    if table not in _db_tables:
+      TYPES = {str: "text", bool: "integer", int: "integer", float: "numeric", bytes: "blob"}
+      ltypes = ', '.join(f"{k} {TYPES[type(key[k])]}" for k in key.keys())
+      cur.execute(f"CREATE TABLE IF NOT EXISTS '{table}_{VERSION}' ({ltypes}, val blob, atime integer, PRIMARY KEY ({', '.join(key.keys())}))")
+      _db_tables.add(table)
+    cur.execute(f"REPLACE INTO '{table}_{VERSION}' ({', '.join(key.keys())}, val, atime) VALUES ({', '.join(['?']*len(key))}, ?, ?)", tuple(key.values()) + (val, int(time.time())))  # noqa: E501
   conn.commit()
   cur.close()
+
+@atexit.register
+def diskcache_flush():
+  global _db_last_flush
+  with _db_flush_lock:
+    with _db_lock: pending = list(_db_pending.items())
+    if pending: _db_write([row for _,row in pending])
+    # rows stay visible to diskcache_get until they are committed, and aren't dropped if they were replaced in the meantime
+    with _db_lock:
+      for k,row in pending:
+        if _db_pending.get(k) is row: del _db_pending[k]
+    _db_last_flush = time.perf_counter()
+
+def _db_writer_loop():
+  while True:
+    _db_wakeup.wait(FLUSH_INTERVAL)
+    _db_wakeup.clear()
+    diskcache_flush()
+
+def diskcache_put(table:str, key:dict|str|int, val:Any, prepickled=False):
+  global _db_puts, _db_writer
+  if CACHELEVEL < 1: return val
+  if isinstance(key, (str,int)): key = {"key": key}
+  if _db_recorded is not None: _db_recorded.add((table, tuple(key.items())))
+  row = (table, key, val if prepickled else pickle.dumps(val))
+  _mem_pop(_mem_key(table, key))
+  if CACHE_BATCH > 1 or CACHE_ASYNC:
+    with _db_lock: _db_pending[(table, tuple(key.items()))] = row
+    full = len(_db_pending) >= CACHE_BATCH.value or time.perf_counter() - _db_last_flush >= FLUSH_INTERVAL
+    if CACHE_ASYNC:
+      if _db_writer is None: (_db_writer:=threading.Thread(target=_db_writer_loop, name="diskcache_writer", daemon=True)).start()
+      if full: _db_wakeup.set()
+    elif full: diskcache_flush()
+  else: _db_write([row])
+  if _evicting() and (_db_puts:=_db_puts+1) % EVICT_INTERVAL == 0: diskcache_evict()
   return val
 
+def diskcache_migrate(table:str, old_version:int, rekey:Callable[[Any], str|int]) -> int:
+  """Copies the rows of `table` from an older cache VERSION into the current one, computing new keys with `rekey`. Returns the rows copied."""
+  if CACHELEVEL < 1: return 0
+  conn = db_connection()
+  cur = conn.cursor()
+  try:
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{table}_{VERSION}",)).fetchone() is not None: return 0
+    if (ktype:=cur.execute(f"SELECT type FROM pragma_table_info('{table}_{old_version}') WHERE name = 'key'").fetchone()) is None: return 0
+    # the rows are copied and rekeyed inside sqlite in one transaction, a big cache isn't loaded into memory or committed row by row
+    conn.create_function("diskcache_rekey", 1, rekey, deterministic=True)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS '{table}_{VERSION}' (key {ktype[0]}, val blob, atime integer, PRIMARY KEY (key))")
+    copied = cur.execute(f"REPLACE INTO '{table}_{VERSION}' (key, val, atime) SELECT diskcache_rekey(key), val, ? FROM '{table}_{old_version}'",
+                         (int(time.time()),)).rowcount
+    conn.commit()
+  finally: cur.close()
+  _db_tables.add(table)
+  if DEBUG >= 1 and copied: print(f"diskcache: migrated {copied} rows of {table} from version {old_version}")
+  return copied
+
 def diskcache(func:Callable[..., T]):
   def wrapper(*args, **kwargs) -> T:
     table, key = f"cache_{func.__name__}", hashlib.sha256(pickle.dumps((args, kwargs))).hexdigest()
@@ -1,6 +1,6 @@
 import itertools
 from tinygrad.opt.kernel import Kernel, Opt, OptOps, KernelOptError, AxisType
-from tinygrad.helpers import getenv, DEBUG, prod, NOLOCALS
+from tinygrad.helpers import getenv, DEBUG, prod, NOLOCALS, CPU_THREADS
 from tinygrad.dtype import ImageDType
 from tinygrad.uop.ops import Ops, resolve
 
@@ -119,4 +119,13 @@ def hand_coded_optimizations(k:Kernel) -> list[Opt]:
         k.apply_opt(Opt(OptOps.LOCAL, axis, local_sz))
         if will_delete_shape: deleted_shape += 1
 
+  # **** cpu threads ****
+
+  # split the outermost loop across the cpu threads if every thread gets enough work to pay for the launch
+  if k.opts.has_threads and CPU_THREADS.value > 1 and k.axes_of(AxisType.LOOP) and isinstance(work:=prod(k.full_shape), int) and \
+     isinstance(loop_sz:=k.full_shape[thread_axis:=k.axes_of(AxisType.LOOP)[0]], int):
+    if (threads:=next((t for t in range(min(CPU_THREADS.value, loop_sz), 1, -1)
+                       if loop_sz % t == 0 and work//t >= getenv("CPU_THREAD_WORK", 1<<15)), None)):
+      k.apply_opt(Opt(OptOps.THREAD, thread_axis, threads))
+
   return k.applied_opts
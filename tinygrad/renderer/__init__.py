@@ -115,6 +115,7 @@ class Renderer:
   supports_float4: bool = True
   has_local: bool = True
   has_shared: bool = True
+  has_threads: bool = False  # the outermost loop can be split across cpu threads, the thread index is the only global dim
   # NOTE: these two should be in (x,y,z) order to match the max_sizes argument in get_grouped_dims
   global_max: tuple[int, ...]|None = (0x8FFFFFFF,) * (3) # TODO: Ops.SPECIAL int32 indexes right now
   local_max: tuple[int, ...]|None = (0x8FFFFFFF,) * (3) # TODO: Ops.SPECIAL int32 indexes right now
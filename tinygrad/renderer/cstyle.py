@@ -190,6 +190,7 @@ class ClangRenderer(CStyleLanguage):
   float4_style = ('{', '}')
   gep_arr_threshold = 0
   has_local = False
+  has_threads = True
   global_max = None
   infinity = "__builtin_inff()"
   nan = '__builtin_nanf("")'
@@ -197,6 +198,7 @@ class ClangRenderer(CStyleLanguage):
 
   # language options
   buffer_suffix = " restrict"
+  code_for_workitem = {"g": lambda _: "core_id"}
   type_map = {dtypes.bool:"_Bool", dtypes.half:"__fp16"}
   code_for_op = {**({k:v for k,v in CStyleLanguage.code_for_op.items() if k not in [Ops.EXP2, Ops.SIN, Ops.LOG2]}),
                  Ops.SQRT: lambda x,dtype: f"__builtin_sqrt({x})" if dtype == dtypes.float64 else f"__builtin_sqrtf({x})"}
@@ -231,6 +233,8 @@ class ClangRenderer(CStyleLanguage):
   def _render_entry(self, function_name:str, bufs:list[tuple[str,tuple[DType,bool]]]) -> str: return ""
 
   def render_kernel(self, function_name, kernel, bufs, uops, prefix=None) -> str:
+    # a threaded kernel gets the index of its thread as the last argument
+    if any(u.op is Ops.SPECIAL for u in uops): bufs = bufs + [("core_id", (dtypes.int, False))]
     defines = '\n'.join(self._render_defines(uops))
     return defines + "\n" + self._render_body(function_name, kernel, bufs, uops, prefix) + "\n" + self._render_entry(function_name, bufs)
 
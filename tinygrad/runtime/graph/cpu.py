@@ -0,0 +1,70 @@
+import ctypes, platform, time, itertools
+from typing import cast
+from tinygrad.helpers import CPU_THREADS
+from tinygrad.device import Buffer
+from tinygrad.engine.realize import ExecItem, CompiledRunner
+from tinygrad.engine.jit import GraphRunner, GraphException
+from tinygrad.uop.ops import Variable
+
+class CPUGraph(GraphRunner):
+  def __init__(self, jit_cache: list[ExecItem], input_rawbuffers: list[Buffer], var_vals: dict[Variable, int]):
+    super().__init__(jit_cache, input_rawbuffers, var_vals)
+    if not all(isinstance(ji.prg, CompiledRunner) for ji in jit_cache): raise GraphException
+
+    # a kernel only depends on kernels of lower levels, so the kernels of a level can run at the same time. with one thread it's in order
+    # NOTE: the memory planner puts the intermediates in one arena, so accesses are tracked by their byte range in the base and not by the base
+    levels: list[int] = []
+    accesses: list[tuple[int, int, int, bool, int]] = []
+    for j,ji in enumerate(jit_cache):
+      outs = cast(CompiledRunner, ji.prg).p.outs
+      ranges = [(id(b.base._buf), b.offset, b.offset+b.nbytes, i in outs) for i,b in enumerate(cast(list[Buffer], ji.bufs))]
+      deps = [d for base,st,en,w,d in accesses if any(base == b and st < e and s < en and (w or bw) for b,s,e,bw in ranges)]
+      levels.append(max([levels[d]+1 for d in deps], default=0) if CPU_THREADS.value > 1 else j)
+      accesses.extend((*r, j) for r in ranges)
+
+    # the parts of a wave run in parallel on the device pool and the waves run one after another. levels of one kernel share a part
+    parts: list[list[int]] = []
+    self.waves: list[list[int]] = []
+    for _,group in itertools.groupby(sorted(range(len(jit_cache)), key=lambda j: levels[j]), key=lambda j: levels[j]):
+      if len(js:=list(group)) == 1 and self.waves and len(self.waves[-1]) == 1: parts[self.waves[-1][0]].extend(js)
+      else:
+        self.waves.append(list(range(len(parts), len(parts)+len(js))))
+        parts.extend([j] for j in js)
+
+    # the batch is one C function calling the kernels of a part at their loaded address, fixed buffers are baked in as constants
+    # and the input buffers and variables are read from the two arrays passed in at launch
+    vtype = "long long" if platform.machine() == "arm64" else "int"  # matches the int args of CPUComputeQueue._exec
+    typedef = self.dev.renderer.kernel_typedef
+    lines = []
+    for p,part in enumerate(parts):
+      lines.append(f"  case {p}:")
+      for j in part:
+        ji, prg = jit_cache[j], cast(CompiledRunner, jit_cache[j].prg)
+        bufs = [f"(void*)in[{self.input_replace[(j,i)]}]" if (j,i) in self.input_replace else f"(void*){cast(Buffer, b)._buf.va_addr:#x}ull"
+                for i,b in enumerate(ji.bufs)]
+        vals = [f"({vtype})vals[{self.vars.index(v)}]" if v in self.vars and v not in ji.fixedvars else f"{ji.fixedvars[v]}" for v in prg.p.vars]
+        sig = ', '.join(["void*"]*len(bufs) + [vtype]*len(vals)) or "void"
+        lines.append(f"    (({typedef} (*)({sig})){ctypes.cast(prg._prg.fxn, ctypes.c_void_p).value:#x}ull)({', '.join(bufs + vals)});")
+      lines.append("    break;")
+    self.src = f"{typedef} batch(unsigned long long *in, long long *vals, unsigned long long part) {{\n  switch (part) {{\n" + \
+               '\n'.join(lines) + "\n  }\n}"
+    self.prg = self.dev.runtime("batch", self.dev.compiler.compile(self.src))
+
+    self.input_bufs = (ctypes.c_uint64 * len(input_rawbuffers))()
+    self.var_vals = (ctypes.c_int64 * max(len(self.vars), 1))()
+
+  def __call__(self, input_rawbuffers: list[Buffer], var_vals: dict[Variable, int], wait=False) -> float|None:
+    for input_idx in self.input_replace.values(): self.input_bufs[input_idx] = input_rawbuffers[input_idx]._buf.va_addr
+    for i,v in enumerate(self.vars): self.var_vals[i] = var_vals[v]
+    args = (ctypes.c_uint64(ctypes.addressof(self.input_bufs)), ctypes.c_uint64(ctypes.addressof(self.var_vals)))
+    st = time.perf_counter()
+    for wave in self.waves:
+      # ctypes releases the GIL for the call, this thread runs the first part
+      parts = [self.dev.thread_pool(len(wave)-1).submit(self.prg.fxn, *args, ctypes.c_uint64(p)) for p in wave[1:]]
+      self.prg.fxn(*args, ctypes.c_uint64(wave[0]))
+      for part in parts: part.result()
+    return time.perf_counter() - st if wait else None
+
+  # threaded kernels run in parallel when launched by the queue, so they aren't batched by the jit
+  @staticmethod
+  def supports_exec_item(dev, ei:ExecItem) -> bool: return isinstance(ei.prg, CompiledRunner) and ei.prg.p.launch_dims({})[0] in (None, [1,1,1])
@@ -1,5 +1,5 @@
 from __future__ import annotations
-import platform, subprocess, sys, ctypes, functools, time, mmap
+import platform, subprocess, sys, ctypes, functools, time, mmap, concurrent.futures
 from tinygrad.helpers import capstone_flatdump, getenv, from_mv, to_mv, OSX, mv_address, wait_cond
 from tinygrad.device import Compiler, BufferSpec, DMACPURef
 from tinygrad.runtime.support.hcq import HCQCompiled, HCQAllocatorBase, HCQBuffer, HWQueue, HCQArgsState, HCQSignal, HCQProgram, MMIOInterface
@@ -22,8 +22,13 @@ class ClangJITCompiler(Compiler):
   def disassemble(self, lib:bytes): return capstone_flatdump(lib)
 
 class CPUComputeQueue(HWQueue):
-  def _exec(self, prg, bufs, *args):
-    prg.fxn(*map(ctypes.c_uint64, args[:bufs]), *map(ctypes.c_int64 if platform.machine() == "arm64" else ctypes.c_int32, args[bufs:]))
+  def _exec(self, prg, bufs, threads, *args):
+    args = (*map(ctypes.c_uint64, args[:bufs]), *map(vtype:=ctypes.c_int64 if platform.machine() == "arm64" else ctypes.c_int32, args[bufs:]))
+    if threads == 1: return prg.fxn(*args)
+    # a threaded kernel runs the other parts on the device pool while this thread runs the first, ctypes releases the GIL for the call
+    parts = [prg.dev.thread_pool(threads-1).submit(prg.fxn, *args, vtype(core_id)) for core_id in range(1, threads)]
+    prg.fxn(*args, vtype(0))
+    for part in parts: part.result()
   def _signal(self, signal_addr, value): to_mv(signal_addr, 4).cast('I')[0] = value
   def _wait(self, signal_addr, value): wait_cond(lambda: to_mv(signal_addr, 4).cast('I')[0] >= value, timeout_ms=60000)
   def _timestamp(self, timestamp_addr): to_mv(timestamp_addr, 8).cast('Q')[0] = time.perf_counter_ns()
@@ -33,7 +38,7 @@ class CPUComputeQueue(HWQueue):
 
   def memory_barrier(self): return self
   def exec(self, prg:CPUProgram, args_state:HCQArgsState, global_size, local_size):
-    return self.cmd(self._exec, prg, len(args_state.bufs), *[x.va_addr for x in args_state.bufs], *args_state.vals)
+    return self.cmd(self._exec, prg, len(args_state.bufs), global_size[0], *[x.va_addr for x in args_state.bufs], *args_state.vals)
   def wait(self, signal, value=0): return self.cmd(self._wait, signal.value_addr, value)
   def timestamp(self, signal): return self.cmd(self._timestamp, signal.timestamp_addr)
   def signal(self, signal, value:sint=0): return self.cmd(self._signal, signal.value_addr, value)
@@ -98,6 +103,17 @@ class CPUAllocator(HCQAllocatorBase):
     if buf.view is None or not isinstance(buf.view, MMIOInterface): raise RuntimeError("Cannot map buffer without view to cpu")
 
 class CPUDevice(HCQCompiled):
+  threadsafe_runtime = True  # CPUProgram only maps the binary, it doesn't touch the allocator or the queues
   def __init__(self, device:str=""):
+    from tinygrad.runtime.graph.cpu import CPUGraph
+    self.pool: concurrent.futures.ThreadPoolExecutor|None = None
+    self.pool_size = 0
     super().__init__(device, CPUAllocator(self), ClangRenderer(), ClangJITCompiler(), functools.partial(CPUProgram, self), HCQSignal, CPUComputeQueue,
-                     supports_graph=False)
+                     graph=CPUGraph)
+
+  def thread_pool(self, workers:int) -> concurrent.futures.ThreadPoolExecutor:
+    # the pool grows to the threads of the kernels that run, those are set by CPU_THREADS when a kernel is compiled, not when the device is opened
+    if self.pool is None or workers > self.pool_size:
+      if self.pool is not None: self.pool.shutdown(wait=False)
+      self.pool, self.pool_size = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="cpu"), workers
+    return self.pool
@@ -35,6 +35,7 @@ dsp_string = PatternMatcher([
 
 class DSPRenderer(ClangRenderer):
   device = "DSP"
+  has_threads = False
   supports_float4 = True
   buffer_suffix = " restrict __attribute__((align_value(128)))"
   kernel_typedef = "__attribute__((noinline)) void"
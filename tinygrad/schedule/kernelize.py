@@ -1,9 +1,12 @@
+import collections
+from typing import Callable
 from dataclasses import dataclass
 from tinygrad.uop.ops import UOp, Ops, GroupOp, PatternMatcher, UPat, graph_rewrite, graph_rewrite_map, identity_element, resolve, sint
-from tinygrad.uop.ops import track_rewrites, _substitute
+from tinygrad.uop.ops import track_rewrites, _substitute, RewriteContext, can_pad
 from tinygrad.uop.spec import type_verify, tensor_uop_spec
 from tinygrad.uop.symbolic import symbolic_simple
 from tinygrad.helpers import Metadata, all_int, all_same, colored, prod, dedup, unwrap, getenv, pluralize, FUSE_ARANGE, DEBUG, SPLIT_REDUCEOP
+from tinygrad.helpers import SCHEDULE_CACHE, MEMORY_BUDGET, ContextVar, schedule_pass
 from tinygrad.dtype import ImageDType
 from tinygrad.schedule.multi import multi_pm
 from tinygrad.shape.shapetracker import ShapeTracker
@@ -416,26 +419,10 @@ finalize_contiguous = PatternMatcher([
 
 remove_tags = PatternMatcher([(UPat(GroupOp.All, name="x"), lambda x: x.replace(tag=None) if x.tag is not None else None)])
 
-@track_rewrites(name=lambda sink,ret: f"Schedule {pluralize('Kernel',len([u for u in ret[sink].toposort() if u.op is Ops.KERNEL]))}")
-def get_kernelize_map(sink:UOp) -> dict[UOp, UOp]:
-  """
-  Function to transform the Tensor UOp graph into a version with Ops.KERNEL
-
-  Args:
-    sink: The Ops.SINK rooting the Tensor graph.
-
-  Returns:
-    Map transforming each UOp in the sink to the Ops.KERNEL graph.
-  """
-
-  # multi + merge_views + simplify
-  tensor_map = graph_rewrite_map(sink, multi_pm+do_fuse+merge_views+sym+replace_contiguous, ctx={}, name="merge_views")
-
-  # display the cleaned up tensor graph
-  if getenv("VIZ"): graph_rewrite(tensor_map[sink], PatternMatcher([]), name="View Tensor Graph")
+# **** kernel graph
 
+def create_kernel_map(sink:UOp, tensor_map:dict[UOp, UOp], realize_map:dict[UOp, None]) -> dict[UOp, UOp]:
   # insert contiguous in places determined by the realize map
-  realize_map = group_realizes(tensor_map[sink])
   tensor_map = graph_rewrite_map(tensor_map[sink], add_contiguous, ctx=realize_map, bottom_up=True, input_map=tensor_map, name="add_contiguous")
   tensor_map = graph_rewrite_map(tensor_map[sink], finalize_contiguous+remove_tags, input_map=tensor_map, name="finalize_contiguous")
 
@@ -462,11 +449,146 @@ def get_kernelize_map(sink:UOp) -> dict[UOp, UOp]:
   # finally, create the AST for kernels
   tensor_map = graph_rewrite_map(tensor_map[sink], create_ast+replace_metadata, bottom_up=True, input_map=tensor_map, name="create_ast")
 
+  return tensor_map
+
+# **** rematerialize
+
+# an elementwise kernel that's only read by other kernels can be recomputed in its readers instead of keeping its buffer live.
+# when the intermediate buffers are over MEMORY_BUDGET, the scheduler picks the ones that are recomputed
+
+def intermediate_buffers(sink:UOp, sched_sink:UOp) -> list[UOp]:
+  keep = {u for u in sink.toposort() if u.op is Ops.BUFFER} | {s.base.buf_uop for s in sched_sink.src if s.base.op is Ops.ASSIGN}
+  return [u.buf_uop for u in sched_sink.toposort() if u.op is Ops.ASSIGN and u.src[0].op is Ops.BUFFER and u.buf_uop not in keep]
+
+def masked_readers(x:UOp, children:dict[UOp, list[UOp]], realize_map:dict[UOp, None]) -> bool:
+  # a masked view on an unrealized UOp after x pads x too once it's recomputed, like the cat of c*a and c*b pads c
+  stack, seen = [x], {x}
+  while stack:
+    for c in children.get(stack.pop(), []):
+      if c.op is Ops.VIEW and any(v.mask is not None for v in c.arg.views): return True
+      if c not in seen and c not in realize_map and c.op is not Ops.REDUCE_AXIS:
+        seen.add(c)
+        stack.append(c)
+  return False
+
+def can_rematerialize(x:UOp, children:dict[UOp, list[UOp]], kernel_map:dict[UOp, UOp], assigned:set[UOp], realize_map:dict[UOp, None]) -> bool:
+  if x.op not in {*GroupOp.ALU, Ops.CAST, Ops.BITCAST} or (a:=kernel_map[x].base).op is not Ops.ASSIGN or a.src[0].op is not Ops.BUFFER: return False
+  # the kernel doesn't reduce and it only reads buffers that aren't assigned to
+  if any(u.op is Ops.REDUCE_AXIS for u in a.src[1].arg.ast.toposort()): return False
+  if any(s.op not in {Ops.BUFFER, Ops.ASSIGN} or s.buf_uop in assigned for s in a.src[1].src[1:]): return False
+  # the readers are kernels that can recompute it, a masked view in them needs a safe pad
+  if any(c.op in {Ops.SINK, Ops.ASSIGN, Ops.COPY, Ops.BUFFER_VIEW, Ops.MSELECT, Ops.MSTACK} for c in children.get(x, [])): return False
+  return can_pad(a.src[1].arg.ast, {}) or not masked_readers(x, children, realize_map)
+
+def rematerialize(sink:UOp, tensor_map:dict[UOp, UOp], realize_map:dict[UOp, None], kernel_map:dict[UOp, UOp],
+                  rematerialize_buffers:Callable[[UOp, list[UOp], list[UOp]], list[UOp]]) -> dict[UOp, UOp]:
+  children: dict[UOp, list[UOp]] = {}
+  for u in tensor_map[sink].toposort():
+    for s in u.src: children.setdefault(s.base, []).append(u)
+  assigned = {u.buf_uop for u in sink.toposort() if u.op is Ops.ASSIGN}
+  candidates = {kernel_map[x].base.buf_uop:x for x in realize_map if can_rematerialize(x, children, kernel_map, assigned, realize_map)}
+  # a kernel behind a masked view doesn't read other candidates, recomputing them in it could make its pad unsafe
+  candidates = {b:x for b,x in candidates.items() if not masked_readers(x, children, realize_map) or
+                not any(s.buf_uop in candidates for s in kernel_map[x].base.src[1].src[1:])}
+  if not (picked:=rematerialize_buffers(kernel_map[sink], intermediate_buffers(sink, kernel_map[sink]), list(candidates))): return kernel_map
+  # the kernel graph is made once more without the picked buffers
+  recomputed = {candidates[b] for b in picked}
+  return create_kernel_map(sink, tensor_map, {k:None for k in realize_map if k not in recomputed})
+
+# **** structural cache
+
+# the kernelize map only depends on the structure of the graph and the context, so it's cached with the BUFFERs as numbered placeholders.
+# the BUFFERs that kernelize creates are placeholders too, a hit creates them again
+kernelize_cache: collections.OrderedDict[tuple[UOp, tuple, Callable|None], tuple[UOp, list[UOp], set[UOp]]] = collections.OrderedDict()
+
+def _placeholder(i:int, b:UOp) -> UOp: return b.replace(src=(UOp(Ops.UNIQUE, arg=-1-i),)+b.src[1:])
+
+def _unlowered_kernels(root:UOp) -> tuple[set[UOp], list[UOp]]:
+  # a KERNEL that isn't lowered to an AST keeps the graph with its BUFFERs in the arg. returns those KERNELs and all the BUFFERs
+  kernels: set[UOp] = set()
+  seen: set[UOp] = set()
+  bufs: dict[UOp, None] = {}
+  stack = [root]
+  while stack:
+    for u in stack.pop().toposort():
+      if u.op is Ops.BUFFER: bufs[u] = None
+      elif u.op is Ops.KERNEL and u not in seen:
+        seen.add(u)
+        if any(x.op is Ops.BUFFER for x in u.arg.ast.toposort()):
+          kernels.add(u)
+          stack.append(u.arg.ast)
+  return kernels, list(bufs)
+
+# ctx is the BUFFER replacements and the unlowered KERNELs, their graph is in the arg
+def replace_buffers(root:UOp, ctx:tuple[dict[UOp, UOp], set[UOp]]) -> UOp:
+  return graph_rewrite(root, pm_replace_buffers, ctx, bottom_up=True, name="replace buffers")
+def replace_kernel_buffers(ctx:tuple[dict[UOp, UOp], set[UOp]], k:UOp):
+  if k not in ctx[1]: return None
+  # a KERNEL can be in the graph of many KERNELs, its graph is only rewritten once
+  if k not in ctx[0]: ctx[0][k] = k.replace(arg=Kernel(replace_buffers(k.arg.ast, ctx), k.arg.metadata))
+  return ctx[0][k]
+
+pm_replace_buffers = PatternMatcher([
+  (UPat(Ops.BUFFER, name="b"), lambda ctx,b: ctx[0].get(b)),
+  (UPat(Ops.KERNEL, name="k"), replace_kernel_buffers),
+])
+
+def get_kernelize_map(sink:UOp, rematerialize_buffers:Callable[[UOp, list[UOp], list[UOp]], list[UOp]]|None=None) -> dict[UOp, UOp]:
+  """
+  Function to transform the Tensor UOp graph into a version with Ops.KERNEL
+
+  Args:
+    sink: The Ops.SINK rooting the Tensor graph.
+    rematerialize_buffers: With MEMORY_BUDGET, picks the intermediate buffers of the kernel graph that are recomputed in their readers.
+
+  Returns:
+    Map transforming each UOp in the sink to the Ops.KERNEL graph.
+  """
+  topo = sink.toposort()
+  # a graph with KERNELs was kernelized before, it isn't cached
+  if not SCHEDULE_CACHE or getenv("VIZ") or any(u.op is Ops.KERNEL for u in topo): return _get_kernelize_map(sink, rematerialize_buffers)
+  bufs = [u for u in topo if u.op is Ops.BUFFER]
+  # NOTE: this doesn't use graph_rewrite_map, the placeholder graph must not collect metadata
+  (rctx:=RewriteContext(None, _substitute, {b:_placeholder(i, b) for i,b in enumerate(bufs)})).unified_rewrite(sink)
+  key = (rctx.replace[sink], tuple(v.value for v in ContextVar._cache.values()), rematerialize_buffers)
+  if (cached:=kernelize_cache.get(key)) is None:
+    ret = _get_kernelize_map(sink, rematerialize_buffers)
+    # the map also has the UOps of the graphs in between. they're cached too, a Tensor that is substituted with the map can become one of them
+    amap = UOp.sink(*ret, *ret.values())
+    unlowered, out_bufs = _unlowered_kernels(amap)
+    new_bufs = [b for b in out_bufs if b not in rctx.replace]
+    placeholders = {b:_placeholder(i, b) for i,b in enumerate(bufs+new_bufs)}
+    amap = replace_buffers(amap, (placeholders, unlowered))
+    kernelize_cache[key] = (amap, [placeholders[b] for b in new_bufs], _unlowered_kernels(amap)[0])
+    if len(kernelize_cache) > SCHEDULE_CACHE.value: kernelize_cache.popitem(last=False)
+    return ret
+  kernelize_cache.move_to_end(key)
+  amap, new_placeholders, unlowered = cached
+  concrete = {_placeholder(i, b):b for i,b in enumerate(bufs)} | {p:p.replace(src=(UOp.unique(),)+p.src[1:]) for p in new_placeholders}
+  ret = replace_buffers(amap, (concrete, unlowered)).src
+  return dict(zip(ret[:len(ret)//2], ret[len(ret)//2:]))
+
+@track_rewrites(name=lambda sink,_,ret: f"Schedule {pluralize('Kernel',len([u for u in ret[sink].toposort() if u.op is Ops.KERNEL]))}")
+def _get_kernelize_map(sink:UOp, rematerialize_buffers:Callable[[UOp, list[UOp], list[UOp]], list[UOp]]|None) -> dict[UOp, UOp]:
+  # multi + merge_views + simplify
+  tensor_map = graph_rewrite_map(sink, multi_pm+do_fuse+merge_views+sym+replace_contiguous, ctx={}, name="merge_views")
+
+  # display the cleaned up tensor graph
+  if getenv("VIZ"): graph_rewrite(tensor_map[sink], PatternMatcher([]), name="View Tensor Graph")
+
+  # the grouper decides which UOps realize, then they're grouped into kernels
+  with schedule_pass("grouper"): realize_map = group_realizes(tensor_map[sink])
+  kernel_map = create_kernel_map(sink, tensor_map, realize_map)
+
+  # recompute elementwise intermediates if their memory is over MEMORY_BUDGET
+  if MEMORY_BUDGET and rematerialize_buffers is not None:
+    with schedule_pass("rematerialize"): kernel_map = rematerialize(sink, tensor_map, realize_map, kernel_map, rematerialize_buffers)
+
   # display the final graph
-  sched_sink = tensor_map[sink]
+  sched_sink = kernel_map[sink]
   if getenv("VIZ"): graph_rewrite(sched_sink, PatternMatcher([]), name="View Kernel Graph")
 
   # verify Kernels match the spec
   if __debug__: type_verify(list(sched_sink.toposort()), tensor_uop_spec)
 
-  return tensor_map
+  return kernel_map
@@ -6,23 +6,33 @@ from typing import Callable, ClassVar, Sequence, cast, get_args, Literal, Suppor
 from tinygrad.dtype import DType, DTypeLike, dtypes, ImageDType, ConstType, least_upper_float, least_upper_dtype, sum_acc_dtype, to_dtype, truncate
 from tinygrad.dtype import _from_np_dtype, _to_np_dtype
 from tinygrad.helpers import argfix, make_tuple, flatten, prod, all_int, round_up, merge_dicts, argsort, getenv, all_same, fully_flatten, dedup
-from tinygrad.helpers import IMAGE, WINO, Metadata, TRACEMETA, ceildiv, fetch, polyN, unwrap, DEBUG, is_numpy_ndarray
+from tinygrad.helpers import IMAGE, WINO, Metadata, TRACEMETA, ceildiv, fetch, polyN, unwrap, DEBUG, is_numpy_ndarray, schedule_pass
 from tinygrad.gradient import compute_gradient
 from tinygrad.uop.ops import smax, smin, resolve, UOp, Ops, sint, Variable, MathTrait, identity_element, all_metadata
 from tinygrad.uop.spec import tensor_uop_spec, type_verify
 from tinygrad.device import Device, Buffer
 from tinygrad.engine.realize import run_schedule
 from tinygrad.engine.memory import memory_planner
-from tinygrad.engine.schedule import ScheduleItem, create_schedule_with_vars
+from tinygrad.engine.schedule import ScheduleItem, create_schedule_with_vars, rematerialize_buffers
 from tinygrad.schedule.kernelize import get_kernelize_map
 
 # *** all in scope Tensors are here. this gets relevant UOps ***
 
 all_tensors: dict[weakref.ref[Tensor], None] = {}
+# the Tensors of each UOp, maintained by the Tensor.uop setter. a UOp is removed with its last Tensor, so this doesn't keep UOps alive
+uop_tensors: dict[UOp, dict[weakref.ref[Tensor], None]] = {}
+# NOTE: this is the callback of the weakref, it also runs for Tensors freed by the cycle collector, which clears the weakrefs before __del__
+def _untrack_tensor(uop:UOp, tref:weakref.ref[Tensor]):
+  if (trefs:=uop_tensors.get(uop)) is None: return
+  trefs.pop(tref, None)
+  if not trefs: del uop_tensors[uop]
 def _find_all_tensors_for_uops(all_uops: set[UOp]) -> list[Tensor]:
-  return [t for tref in all_tensors if (t:=tref()) is not None and t.uop in all_uops]
+  return [t for u in all_uops if (trefs:=uop_tensors.get(u)) is not None for tref in list(trefs) if (t:=tref()) is not None]
 
 def _apply_map_to_tensors(applied_map:dict[UOp, UOp], name:str|None=None) -> None:
+  # the map can have shared UOps that don't change (like the DEVICE), their children would be all Tensors on the device
+  applied_map = {k:v for k,v in applied_map.items() if k is not v}
+
   # get all children of keys in applied_map
   all_uops: set[UOp] = set()
   search_uops = list(applied_map)
@@ -33,7 +43,6 @@ def _apply_map_to_tensors(applied_map:dict[UOp, UOp], name:str|None=None) -> Non
     search_uops.extend([u for c in x.children if (u:=c()) is not None])
 
   # link the found UOps back to Tensors. exit early if there's no Tensors to realize
-  # NOTE: this uses all_tensors, but it's fast
   if len(fixed_tensors := _find_all_tensors_for_uops(all_uops)):
     # potentially rewrite all the discovered Tensors
     sink = UOp.sink(*[t.uop for t in fixed_tensors])
@@ -119,7 +128,7 @@ class Tensor(MathTrait):
   np.set_printoptions(precision=4)
   ```
   """
-  __slots__ = "uop", "requires_grad", "grad"
+  __slots__ = "_uop", "_tref", "requires_grad", "grad"
   training: ClassVar[bool] = False
 
   def __init__(self, data:ConstType|bytes|list|tuple|UOp|'np.ndarray'|pathlib.Path|None,  # type: ignore [name-defined] # noqa: F821
@@ -165,7 +174,7 @@ class Tensor(MathTrait):
     if not isinstance(data, UOp): raise RuntimeError(f"can't create Tensor from {data!r} with type {type(data)}")
 
     # data might be on a different device
-    if isinstance(device, str): self.uop:UOp = data if data.device == device else data.copy_to_device(device)
+    if isinstance(device, str): self.uop = data if data.device == device else data.copy_to_device(device)
     # if device is a tuple, we should have/construct a MultiLazyBuffer
     elif isinstance(data.device, str): self.uop = Tensor(data).shard(device).uop
     else:
@@ -175,6 +184,25 @@ class Tensor(MathTrait):
     # add to all_tensors after construction succeeds
     all_tensors[weakref.ref(self)] = None
   def __del__(self): all_tensors.pop(weakref.ref(self), None)
+  # the weakref isn't pickled, the uop setter makes a new one
+  def __getstate__(self): return {k:getattr(self, k) for k in ("_uop", "requires_grad", "grad") if hasattr(self, k)}
+  def __setstate__(self, state:dict):
+    for k,v in state.items(): setattr(self, "uop" if k == "_uop" else k, v)
+
+  @property
+  def uop(self) -> UOp: return self._uop
+  @uop.setter
+  def uop(self, uop:UOp):
+    self._untrack_uop()
+    self._tref = weakref.ref(self, functools.partial(_untrack_tensor, uop))
+    uop_tensors.setdefault(uop, {})[self._tref] = None
+    self._uop = uop
+  @uop.deleter
+  def uop(self):
+    self._untrack_uop()
+    del self._uop, self._tref
+  def _untrack_uop(self):
+    if hasattr(self, "_tref"): _untrack_tensor(self._uop, self._tref)
 
   def _apply_uop(self, fxn:Callable, *x:Tensor, **kwargs) -> Tensor:
     new_uop: UOp = fxn(*[t.uop for t in (self,)+x], **kwargs)
@@ -234,8 +262,9 @@ class Tensor(MathTrait):
     # verify Tensors match the spec
     if __debug__: type_verify(list(big_sink.toposort()), tensor_uop_spec)
 
-    becomes_map = get_kernelize_map(big_sink)
-    _apply_map_to_tensors(becomes_map, name="Apply Kernelize Map")
+    with schedule_pass("kernelize"):
+      becomes_map = get_kernelize_map(big_sink, rematerialize_buffers)
+      _apply_map_to_tensors(becomes_map, name="Apply Kernelize Map")
     return self
 
   def schedule_with_vars(self, *lst:Tensor) -> tuple[list[ScheduleItem], dict[Variable, int]]:
@@ -249,12 +278,13 @@ class Tensor(MathTrait):
     sink = UOp.sink(*[x.uop for x in (self,)+lst])
 
     # remove all ASSIGNs, after scheduling, the tensors are just buffers
-    remove_assign_map = {u:u.buf_uop for u in sink.toposort() if u.op is Ops.ASSIGN}
-    _apply_map_to_tensors(remove_assign_map, name="Remove Assigns")
+    with schedule_pass("remove_assigns"):
+      remove_assign_map = {u:u.buf_uop for u in sink.toposort() if u.op is Ops.ASSIGN}
+      _apply_map_to_tensors(remove_assign_map, name="Remove Assigns")
 
     # create the schedule
-    schedule, var_vals = create_schedule_with_vars(sink)
-    schedule = memory_planner(schedule)
+    with schedule_pass("create_schedule_with_vars"): schedule, var_vals = create_schedule_with_vars(sink)
+    with schedule_pass("memory_planner"): schedule = memory_planner(schedule)
     if DEBUG >= 1 and len(schedule) >= 10: print(f"scheduled {len(schedule)} kernels in {(time.perf_counter()-st)*1000:.2f} ms")
     return schedule, var_vals
 
@@ -3931,8 +3961,8 @@ class Tensor(MathTrait):
     print(q.scaled_dot_product_attention(k, v).numpy())
     ```
     """
-    # NOTE: it also works when `key` and `value` have symbolic shape.
-    assert all_int(self.shape), f"does not support symbolic shape {self.shape}"
+    # NOTE: it also works when `key` and `value` have symbolic shape, and with a symbolic query length.
+    assert all_int(self.shape[:-2]+self.shape[-1:]), f"does not support symbolic shape {self.shape}"
     # GQA: https://docs.pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html
     if enable_gqa:
       key = key.repeat_interleave(self.shape[-3] // key.shape[-3], dim=-3)